@@ -0,0 +1,281 @@
+# coding=utf-8
+"""
+进程内的假MySQL服务，只实现了基准测试需要的那部分协议:
+握手(不校验密码)、COM_QUERY、COM_PING、COM_QUIT、COM_SET_OPTION、多语句和LOAD DATA LOCAL。
+和真正的服务一样，客户端没有打开多语句时拒绝一次执行多条语句。
+SELECT忽略WHERE/ORDER BY，只按LIMIT返回表里的前几行，
+写语句只返回影响的行数，不修改数据，保证每次测试的结果一样
+"""
+
+from __future__ import unicode_literals
+
+import re
+import SocketServer
+import struct
+import threading
+from datetime import date, datetime
+
+# 字段类型
+LONGLONG = 0x08
+DOUBLE = 0x05
+DATETIME = 0x0c
+VAR_STRING = 0xfd
+
+# 字符集
+UTF8 = 33
+BINARY = 63
+
+# 服务端的能力: LONG_PASSWORD, LONG_FLAG, CONNECT_WITH_DB, PROTOCOL_41, TRANSACTIONS,
+# SECURE_CONNECTION, MULTI_STATEMENTS, MULTI_RESULTS, PLUGIN_AUTH
+CAPABILITIES = 0x1 | 0x4 | 0x8 | 0x200 | 0x2000 | 0x8000 | 0x10000 | 0x20000 | 0x80000
+
+STATUS_AUTOCOMMIT = 0x0002
+STATUS_MORE_RESULTS = 0x0008
+
+COM_QUIT = 0x01
+COM_QUERY = 0x03
+COM_SET_OPTION = 0x1b
+
+CLIENT_MULTI_STATEMENTS = 0x10000
+
+SELECT_PATTERN = re.compile(r"^\s*SELECT\s+(.*?)(?:\s+FROM\s+([`\w.]+)(.*))?$", re.IGNORECASE | re.DOTALL)
+LIMIT_PATTERN = re.compile(r"\sLIMIT\s+(\d+)", re.IGNORECASE)
+ALIAS_PATTERN = re.compile(r"^(.*?)\s+AS\s+`?(\w+)`?$", re.IGNORECASE)
+
+
+def lenenc_int(n):
+    if n < 251:
+        return struct.pack("<B", n)
+    if n < 1 << 16:
+        return b"\xfc" + struct.pack("<H", n)
+    if n < 1 << 24:
+        return b"\xfd" + struct.pack("<I", n)[:3]
+    return b"\xfe" + struct.pack("<Q", n)
+
+
+def lenenc_str(s):
+    if isinstance(s, unicode):
+        s = s.encode("utf-8")
+    return lenenc_int(len(s)) + s
+
+
+def text_value(v):
+    """值在文本协议里的表示"""
+    if v is None:
+        return b"\xfb"
+    if isinstance(v, datetime):
+        v = v.strftime("%Y-%m-%d %H:%M:%S")
+    elif isinstance(v, date):
+        v = v.strftime("%Y-%m-%d")
+    elif not isinstance(v, basestring):
+        v = repr(v) if isinstance(v, float) else str(v)
+    return lenenc_str(v)
+
+
+class Table(object):
+    """
+    :param columns: [(字段名, 字段类型)]
+    :param rows: [tuple]，和columns一一对应
+    """
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.index = dict([(name, i) for i, (name, _) in enumerate(columns)])
+        self.rows = rows
+
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.status = STATUS_AUTOCOMMIT
+        self.output = []
+        self.multi_statements = False
+
+    def handle(self):
+        self.seq = 0
+        self.send(self.server.handshake())
+        self.flush()
+        response = self.read()
+        if response is None:
+            return
+        self.multi_statements = bool(struct.unpack("<I", response[:4])[0] & CLIENT_MULTI_STATEMENTS)
+        self.send(self.ok())
+        self.flush()
+        while True:
+            payload = self.read()
+            if payload is None or ord(payload[0]) == COM_QUIT:
+                return
+            if ord(payload[0]) == COM_QUERY:
+                self.query(payload[1:].decode("utf-8"))
+            elif ord(payload[0]) == COM_SET_OPTION:
+                self.multi_statements = struct.unpack("<H", payload[1:3])[0] == 0
+                self.send(self.eof())
+            else:
+                self.send(self.ok())
+            self.flush()
+
+    def read(self):
+        header = self.rfile.read(4)
+        if len(header) < 4:
+            return None
+        length = struct.unpack("<I", header[:3] + b"\0")[0]
+        self.seq = (ord(header[3]) + 1) % 256
+        return self.rfile.read(length)
+
+    def send(self, payload):
+        self.output.append(struct.pack("<I", len(payload))[:3] + struct.pack("<B", self.seq) + payload)
+        self.seq = (self.seq + 1) % 256
+
+    def flush(self):
+        self.wfile.write(b"".join(self.output))
+        self.wfile.flush()
+        self.output = []
+
+    def ok(self, affected=0, insert_id=0, more=False, message=b""):
+        status = self.status | (STATUS_MORE_RESULTS if more else 0)
+        return b"\x00" + lenenc_int(affected) + lenenc_int(insert_id) + struct.pack("<HH", status, 0) + message
+
+    def error(self, code, message):
+        return b"\xff" + struct.pack("<H", code) + b"#42000" + message.encode("utf-8")
+
+    def eof(self, more=False):
+        status = self.status | (STATUS_MORE_RESULTS if more else 0)
+        return b"\xfe" + struct.pack("<HH", 0, status)
+
+    def query(self, sql):
+        if sql.lstrip()[:15].upper() == "LOAD DATA LOCAL":
+            self.load()
+            return
+        statements = [x for x in sql.split(";") if x.strip()] or [sql]
+        if len(statements) > 1 and not self.multi_statements:
+            self.send(self.error(1064, "You have an error in your SQL syntax near ';'"))
+            return
+        for i, statement in enumerate(statements):
+            more = i < len(statements) - 1
+            result = self.server.execute(self, statement.strip())
+            if isinstance(result[0], list):
+                self.result_set(result[0], result[1], more)
+            else:
+                affected, insert_id = result
+                self.send(self.ok(affected, insert_id, more))
+
+    def load(self):
+        """向客户端要数据，只统计收到的行数"""
+        self.send(b"\xfb" + b"data")
+        self.flush()
+        rows = 0
+        while True:
+            payload = self.read()
+            if not payload:
+                break
+            rows += payload.count(b"\n")
+        self.send(self.ok(rows, message=b"Records: %d  Deleted: 0  Skipped: 0  Warnings: 0" % rows))
+
+    def result_set(self, columns, rows, more):
+        self.send(lenenc_int(len(columns)))
+        for name, type_code in columns:
+            charset = UTF8 if type_code == VAR_STRING else BINARY
+            self.send(lenenc_str("def") + lenenc_str("") + lenenc_str("") + lenenc_str("") +
+                      lenenc_str(name) + lenenc_str(name) + b"\x0c" +
+                      struct.pack("<HIBHBxx", charset, 255, type_code, 0, 0))
+        self.send(self.eof())
+        for row in rows:
+            self.send(b"".join([text_value(v) for v in row]))
+        self.send(self.eof(more))
+
+
+class FakeMySQLServer(SocketServer.ThreadingTCPServer):
+    """
+    在后台线程里运行的假MySQL服务
+    :param tables: 表名(不带库名) -> Table
+    >>> server = FakeMySQLServer({"user": Table([("id", LONGLONG)], [(1, ), (2, )])})
+    >>> server.start()
+    >>> Pool(port=server.port).session.select("SELECT `id` FROM tt.user LIMIT 1")
+    [{u'id': 1}]
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, tables, host="127.0.0.1", port=0):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port), Handler)
+        self.tables = tables
+        self.variables = {"@@max_allowed_packet": 64 * 1024 * 1024,
+                          "@@auto_increment_increment": 1}
+        self.lock = threading.Lock()
+        self.insert_id = 0
+        self.thread_id = 0
+        self.queries = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handshake(self):
+        with self.lock:
+            self.thread_id += 1
+            thread_id = self.thread_id
+        salt = b"12345678901234567890"
+        return (b"\x0a" + b"5.7.0-fake\0" + struct.pack("<I", thread_id) + salt[:8] + b"\0" +
+                struct.pack("<HBHHB", CAPABILITIES & 0xffff, UTF8, STATUS_AUTOCOMMIT,
+                            CAPABILITIES >> 16, 21) +
+                b"\0" * 10 + salt[8:] + b"\0" + b"mysql_native_password\0")
+
+    def execute(self, handler, sql):
+        """
+        :return: 查询返回[columns, rows]，写语句返回(affected, insert_id)
+        """
+        with self.lock:
+            self.queries += 1
+        head = sql[:16].upper()
+        if head.startswith("SELECT"):
+            return self.select(sql)
+        if head.startswith("INSERT"):
+            affected = sql.count("),(") + 1
+            with self.lock:
+                insert_id = self.insert_id + 1
+                self.insert_id += affected
+            return affected, insert_id
+        if head.startswith("SET AUTOCOMMIT"):
+            if sql.rstrip().endswith("0"):
+                handler.status &= ~STATUS_AUTOCOMMIT
+            else:
+                handler.status |= STATUS_AUTOCOMMIT
+        return 0, 0
+
+    def select(self, sql):
+        match = SELECT_PATTERN.match(sql)
+        exprs, table, rest = match.group(1), match.group(2), match.group(3) or ""
+        table = self.tables.get(table.replace("`", "").split(".")[-1].lower()) if table else None
+        rows = table.rows if table is not None else [()]
+        limit = LIMIT_PATTERN.search(rest)
+        if limit:
+            rows = rows[:int(limit.group(1))]
+        columns, getters = [], []
+        for expr in [x.strip() for x in exprs.split(",")]:
+            alias = ALIAS_PATTERN.match(expr)
+            name = alias.group(2) if alias else expr.replace("`", "")
+            expr = alias.group(1).strip() if alias else expr.replace("`", "")
+            if table is not None and expr in table.index:
+                columns.append((name, table.columns[table.index[expr]][1]))
+                getters.append(lambda row, i=table.index[expr]: row[i])
+            elif expr.upper().startswith("COUNT("):
+                columns.append((name, LONGLONG))
+                getters.append(lambda row, n=len(rows): n)
+                rows = rows[:1] or [()]
+            elif expr in self.variables:
+                columns.append((name, LONGLONG))
+                getters.append(lambda row, v=self.variables[expr]: v)
+            else:
+                columns.append((name, LONGLONG))
+                getters.append(lambda row, v=expr: v)
+        return [columns, [[get(row) for get in getters] for row in rows]]
@@ -0,0 +1,214 @@
+# coding=utf-8
+"""
+测量orMysql自身的开销，连接进程内的假MySQL服务，不需要真正的数据库，
+结果以json输出，方便在不同版本之间比较
+>>> python -m benchmarks.run --rows 10000 --output result.json
+"""
+
+from __future__ import unicode_literals
+
+import argparse
+import gc
+import json
+import platform
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pymysql
+from pymysql.cursors import Cursor
+
+from benchmarks.fake_server import FakeMySQLServer, Table, LONGLONG, VAR_STRING, DATETIME
+from orMysql.db import db, Pool
+from orMysql.fields import IntFiled, StringFiled, DateTimeFiled
+from orMysql.model import Model
+
+
+class User(Model):
+    __tablename__ = "tt.user"
+    id_ = IntFiled(name="id", primary_key=True)
+    name = StringFiled(name="name")
+    create_time = DateTimeFiled(name="create_time")
+
+
+def user_table(rows):
+    """固定内容的user表，每次运行的数据都一样"""
+    start = datetime(2020, 1, 1)
+    return Table([("id", LONGLONG), ("name", VAR_STRING), ("create_time", DATETIME)],
+                 [(i, "user%s" % i, start + timedelta(seconds=i)) for i in range(1, rows + 1)])
+
+
+def measure(func, number, repeat):
+    """
+    执行repeat轮，每轮调用number次func，取最快的一轮，减少其他进程的干扰
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        for _ in range(number):
+            func()
+        times.append(time.time() - start)
+    best = min(times)
+    return {"number": number,
+            "repeat": repeat,
+            "best_seconds": best,
+            "median_seconds": sorted(times)[len(times) // 2],
+            "ops_per_second": number / best if best else None,
+            "us_per_op": best / number * 1e6}
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(p):
+        return values[min(len(values) - 1, int(len(values) * p))]
+    return {"count": len(values),
+            "p50_us": at(0.5) * 1e6,
+            "p95_us": at(0.95) * 1e6,
+            "p99_us": at(0.99) * 1e6,
+            "max_us": values[-1] * 1e6}
+
+
+def bench_sql_build(args):
+    """Queryer和fields.py构造sql的开销"""
+    def build():
+        query = User.query.filter(User.id_ > 10, User.name.like("user%"), User.create_time.is_not_null())
+        return query.order_by(User.id_.desc()).limit(20).offset(40).sql
+
+    def get_sql():
+        return User.get_sql()
+    return {"query": measure(build, args.iterations, args.repeat),
+            "get_sql": measure(get_sql, args.iterations, args.repeat)}
+
+
+def bench_hydrate(args):
+    """
+    Queryer.all()的开销，raw是同样的sql只用Cursor取回tuple，
+    两者的差就是创建对象的开销
+    """
+    number = max(1, args.iterations // args.rows)
+    sql = User.query.sql
+
+    def raw():
+        return db.session.select(sql, [], Cursor)
+
+    def hydrate():
+        return User.query.all()
+    raw_result = measure(raw, number, args.repeat)
+    all_result = measure(hydrate, number, args.repeat)
+    overhead = (all_result["best_seconds"] - raw_result["best_seconds"]) / number / args.rows
+    return {"rows": args.rows,
+            "raw_select": raw_result,
+            "all": all_result,
+            "hydrate_us_per_row": overhead * 1e6}
+
+
+def bench_insert(args):
+    """WrapperConnection.add逐行插入和add_all批量插入的吞吐"""
+    now = datetime(2020, 1, 1)
+
+    def add():
+        db.session.add(User(name="linghaihui", create_time=now))
+
+    def add_all():
+        db.session.add_all([User(name="linghaihui", create_time=now) for _ in range(args.batch_size)],
+                           batch_size=args.batch_size)
+    number = max(1, args.iterations // 10)
+    result = {"add": measure(add, number, args.repeat),
+              "add_all": measure(add_all, max(1, number // args.batch_size), args.repeat)}
+    result["add_all"]["batch_size"] = args.batch_size
+    result["add_all"]["rows_per_second"] = result["add_all"]["ops_per_second"] * args.batch_size
+    return result
+
+
+def bench_load(args):
+    """WrapperConnection.load用LOAD DATA LOCAL流式导入的吞吐"""
+    now = datetime(2020, 1, 1)
+    rows = args.iterations * 10
+
+    def load():
+        db.session.load(User, ((i, "linghaihui", now) for i in xrange(rows)),
+                        fields=["id_", "name", "create_time"])
+    result = measure(load, 1, args.repeat)
+    result["rows"] = rows
+    result["rows_per_second"] = rows / result["best_seconds"]
+    return result
+
+
+def bench_pool(args, port):
+    """N个线程争用连接池时获取连接的延迟"""
+    pool = Pool(port=port, pool_max_size=args.pool_size, timeout=None)
+    latencies = [[] for _ in range(args.threads)]
+    barrier = threading.Event()
+
+    def work(index):
+        barrier.wait()
+        for _ in range(args.checkouts):
+            start = time.time()
+            con = pool.connection
+            latencies[index].append(time.time() - start)
+            pool.put(con)
+    threads = [threading.Thread(target=work, args=(i, )) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    start = time.time()
+    barrier.set()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+    result = percentiles([x for items in latencies for x in items])
+    result.update({"threads": args.threads,
+                   "pool_size": args.pool_size,
+                   "checkouts_per_second": args.threads * args.checkouts / seconds,
+                   "stats": dict([(k, v) for k, v in pool.stats().iteritems() if k != "checkout_wait"])})
+    return result
+
+
+BENCHMARKS = ("sql_build", "hydrate", "insert", "load", "pool")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="orMysql benchmarks against an in-process fake MySQL server")
+    parser.add_argument("--rows", type=int, default=10000, help="rows of the fake table")
+    parser.add_argument("--iterations", type=int, default=20000, help="operations per round")
+    parser.add_argument("--repeat", type=int, default=5, help="rounds, the best round is reported")
+    parser.add_argument("--batch-size", type=int, default=1000, help="rows per add_all call")
+    parser.add_argument("--threads", type=int, default=16, help="threads contending for the pool")
+    parser.add_argument("--pool-size", type=int, default=5, help="pool_max_size of the contended pool")
+    parser.add_argument("--checkouts", type=int, default=1000, help="checkouts per thread")
+    parser.add_argument("--only", choices=BENCHMARKS, action="append", help="run only these benchmarks")
+    parser.add_argument("--output", help="write the json to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    server = FakeMySQLServer({"user": user_table(args.rows)})
+    server.start()
+    try:
+        db.setup_db(port=server.port, password="", pool_max_size=args.pool_size)
+        results = {}
+        for name in args.only or BENCHMARKS:
+            if name == "pool":
+                results[name] = bench_pool(args, server.port)
+            else:
+                results[name] = globals()["bench_" + name](args)
+    finally:
+        server.stop()
+    report = {"meta": {"python": sys.version.split()[0],
+                       "implementation": platform.python_implementation(),
+                       "platform": platform.platform(),
+                       "pymysql": pymysql.__version__,
+                       "args": vars(args)},
+              "results": results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print output
+
+
+if __name__ == "__main__":
+    main()
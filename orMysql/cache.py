@@ -0,0 +1,150 @@
+# coding=utf-8
+
+from __future__ import unicode_literals
+
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# 写语句中的表名
+WRITE_TABLE_PATTERN = re.compile(
+    r"^\s*(?:INSERT(?:\s+IGNORE)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+IGNORE)?|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?)"
+    r"\s+([`\w.]+)", re.IGNORECASE)
+
+
+def table_key(table):
+    """
+    去掉库名和反引号，作为失效的粒度
+    >>> table_key("`tt`.`User`")
+    'user'
+    """
+    return str(table.replace("`", "").split(".")[-1].lower())
+
+
+def write_table(sql):
+    """
+    写语句操作的表，不是写语句时返回None
+    >>> write_table("delete from tt.user where id=1")
+    'user'
+    >>> write_table("SELECT 1") is None
+    True
+    """
+    match = WRITE_TABLE_PATTERN.match(sql)
+    if match:
+        return table_key(match.group(1))
+    return None
+
+
+def approx_size(rows):
+    """结果集大概占用的内存"""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for v in (row.itervalues() if isinstance(row, dict) else row):
+            size += sys.getsizeof(v)
+    return size
+
+
+class QueryCache(object):
+    """
+    进程内共享的查询结果缓存，按条目数和大概的内存大小做LRU淘汰，
+    每个条目有自己的过期时间，写表时该表的条目全部失效
+    :param max_entries: 最多缓存的条目数
+    :param max_bytes: 最多占用的内存，以字节为单位
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> (table, expire, size, rows)，按访问顺序排列
+        self.entries = OrderedDict()
+        # table -> set(key)
+        self.tables = {}
+        # 每次失效时加1，防止写之前开始的查询把旧数据放进缓存
+        self.generations = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def fetch(self, table, key, ttl, loader):
+        """
+        从缓存获取结果，没有命中时调用loader查询并放入缓存
+        :param table: 查询的表
+        :param key: 缓存的key, 一般是(sql, 参数)
+        :param ttl: 过期的秒数
+        :param loader: 查询数据库的函数
+        """
+        table = table_key(table)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return entry[3]
+                self._remove(key, entry)
+                self.expirations += 1
+            self.misses += 1
+            generation = self.generations.get(table, 0)
+        rows = loader()
+        size = approx_size(rows)
+        if size > self.max_bytes:
+            return rows
+        with self.lock:
+            if self.generations.get(table, 0) != generation:
+                return rows
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self._remove(key, old)
+            self.entries[key] = (table, time.time() + ttl, size, rows)
+            self.tables.setdefault(table, set()).add(key)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                old_key, old = self.entries.popitem(last=False)
+                self._remove(old_key, old)
+                self.evictions += 1
+        return rows
+
+    def _remove(self, key, entry):
+        self.bytes -= entry[2]
+        keys = self.tables.get(entry[0])
+        if keys is not None:
+            keys.discard(key)
+
+    def invalidate(self, table):
+        """使一个表所有的缓存失效"""
+        table = table_key(table)
+        with self.lock:
+            self.generations[table] = self.generations.get(table, 0) + 1
+            for key in self.tables.pop(table, ()):
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.bytes -= entry[2]
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tables.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "bytes": self.bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations,
+                    "invalidations": self.invalidations}
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
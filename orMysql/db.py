@@ -3,27 +3,65 @@
 from __future__ import unicode_literals
 
 import os
+import Queue
+import random
+import re
+import struct
+import sys
+import threading
+import time
 import warnings
-from Queue import Queue, Empty
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from itertools import chain, islice
 
 from pymysql.connections import Connection
-from pymysql.cursors import DictCursor
+from pymysql.constants import CLIENT, COMMAND
+from pymysql.protocol import OKPacketWrapper
+from pymysql.cursors import Cursor, DictCursor, SSDictCursor
+from pymysql.err import InterfaceError, OperationalError
 
-from utils import Property, wrapper_str
+from cache import QueryCache, write_table
+from profiler import QueryProfiler
+from utils import Property, Histogram
 
 BASE_PATH = os.path.dirname(os.path.abspath(__file__))
 
+# LOAD DATA返回的信息里面跳过的行数
+SKIPPED_PATTERN = re.compile(br"Skipped: (\d+)")
+
+# COM_SET_OPTION的参数
+MULTI_STATEMENTS_ON = 0
+MULTI_STATEMENTS_OFF = 1
+
+# 连接不能再使用的错误码: CR_CONN_HOST_ERROR, CR_SERVER_GONE_ERROR, CR_SERVER_LOST, CR_COMMANDS_OUT_OF_SYNC
+DISCONNECT_ERRORS = (2003, 2006, 2013, 2014)
+
+
+def is_disconnect(error):
+    """error是不是连接断开引起的，断开的连接不能放回连接池"""
+    if isinstance(error, InterfaceError):
+        return True
+    return isinstance(error, OperationalError) and bool(error.args) and error.args[0] in DISCONNECT_ERRORS
+
 
 class WrapperConnection(Connection):
     """
     the wrapper connection of pymysql.connections.Connection
     """
-    def __init__(self, max_life_time=3600, pool=None, **kwargs):
+    def __init__(self, max_life_time=3600, pool=None, overflow=False, **kwargs):
         self.max_life_time = max_life_time
         self.create_time = datetime.now()
         self.end_time = self.create_time + timedelta(seconds=self.max_life_time)
         self.pool = pool
+        # overflow的连接归还时直接关闭
+        self.overflow = overflow
+        self.checked_out = True
+        # 大于0时连接被db.transaction()持有，不会提交也不会放回连接池
+        self.transaction_depth = 0
+        self._server_limits = None
         super(WrapperConnection, self).__init__(**kwargs)
 
     @property
@@ -34,46 +72,544 @@ class WrapperConnection(Connection):
         return False
 
     def __exit__(self, exc, value, traceback):
-        try:
-            if exc is not None:
+        if self.transaction_depth > 0:
+            return
+        broken = exc is not None and is_disconnect(value)
+        if exc is not None and not broken:
+            try:
                 self.rollback()
-            self.pool.put(self)
-        except Exception as e:
-            print e
+            except Exception:
+                # 回滚失败的连接也不能复用
+                broken = True
+        self.release(broken)
+
+    def commit(self):
+        """commit, inside db.transaction() it is deferred to the end of the transaction"""
+        if self.transaction_depth > 0:
+            return
+        super(WrapperConnection, self).commit()
 
-    def select(self, sql):
+    def release(self, broken=False):
+        """
+        put the connection back into the pool, unless it is held by db.transaction()
+        :param broken: the connection is broken, close it instead
+        """
+        if self.transaction_depth == 0:
+            if broken:
+                self.pool.discard(self)
+            else:
+                self.pool.put(self)
+
+    @contextmanager
+    def _release_on_error(self):
+        """
+        the work before `with self`, put the connection back into the pool if it fails,
+        otherwise a bounded pool loses a connection for every failed call
+        """
+        try:
+            yield
+        except Exception:
+            self.release()
+            raise
+
+    @contextmanager
+    def use_cursor(self, cursor=None):
+        """
+        the same as `with self as cur`, but the cursor class can be specified
+        :param cursor: the cursor class, None means the default DictCursor
+        """
+        try:
+            yield self.cursor(cursor)
+        except Exception:
+            self.__exit__(*sys.exc_info())
+            raise
+        else:
+            self.__exit__(None, None, None)
+
+    def select(self, sql, args=None, cursor=None):
         """
         :param sql : the sql to execute
-        >>> db.session.select(sql)
+        :param args: the params bound to the %s placeholders of sql
+        :param cursor: the cursor class, use pymysql.cursors.Cursor to get tuples
+        >>> db.session.select(sql, [1])
         """
-        with self as cur:
-            cur.execute(sql)
+        with self.use_cursor(cursor) as cur:
+            self._execute(cur, sql, args)
             result = cur.fetchall()
             self.commit()
         return result
 
+    def iter_select(self, sql, args=None, batch_size=1000, cursor=SSDictCursor):
+        """
+        execute the sql with an unbuffered cursor and yield the rows lazily,
+        the connection is put back into the pool after the generator is exhausted or closed
+        :param sql : the sql to execute
+        :param args: the params bound to the %s placeholders of sql
+        :param batch_size: the rows to fetch from the socket every time
+        :param cursor: the unbuffered cursor class, SSCursor to get tuples
+        >>> for row in db.session.iter_select(sql): print row
+        """
+        cur = self.cursor(cursor)
+        start = time.time()
+        # 把行交给调用者之后开始等待的时间，调用者处理行的时间不算在查询时间里
+        waiting = None
+        count = 0
+        broken = False
+        try:
+            cur.execute(sql, args)
+            rows = cur.fetchmany(batch_size)
+            while rows:
+                count += len(rows)
+                waiting = time.time()
+                for row in rows:
+                    yield row
+                start += time.time() - waiting
+                waiting = None
+                rows = cur.fetchmany(batch_size)
+        except Exception as e:
+            broken = is_disconnect(e)
+            raise
+        finally:
+            profiler = Db.get_profiler()
+            if profiler is not None:
+                profiler.observe(sql, (waiting or time.time()) - start, count)
+            try:
+                if not broken:
+                    # 关闭时会读完剩下的结果，保证连接可以复用
+                    cur.close()
+                    self.commit()
+            except Exception:
+                broken = True
+                raise
+            finally:
+                self.release(broken)
+
+    def pipeline(self, queries):
+        """
+        send many queries in one round trip with the multi-statements capability,
+        and walk the result sets in order, statements are split into several
+        round trips only when they exceed the server's max_allowed_packet.
+        unless the pool is created with multi_statements=True, the capability is
+        turned on only for this call, so raw sql elsewhere can not stack statements
+        :param queries: Queryer objects, whose rows are hydrated into their models,
+                        or (sql, args) tuples, whose rows are returned as tuples
+        :return: the list of results, in the order of queries
+        >>> users, logs = db.session.pipeline([User.query.filter(User.id_ < 10), Log.query.limit(5)])
+        """
+        loaders = []
+        rows = []
+        for index, query in enumerate(queries):
+            if isinstance(query, tuple):
+                sql, args = query
+                loaders.append(list)
+            else:
+                sql, args = query.sql, query.params
+                loaders.append(lambda x, query=query: list(query._hydrate(x)))
+            rows.append((index, (sql, args)))
+        results = []
+        with self.use_cursor(Cursor) as cur:
+            max_packet, _ = self.server_limits(self.cursor())
+
+            def render(query):
+                sql = cur.mogrify(*query)
+                # python2的mogrify返回bytes，和其他语句拼接前先解码
+                if isinstance(sql, bytes):
+                    sql = sql.decode(self.encoding)
+                return sql, _byte_size(sql) + 1
+            with self._multi_statements():
+                for statements, _ in _batches(rows, render, 0, len(rows), max_packet):
+                    self._execute(cur, ";".join(statements))
+                    results.append(cur.fetchall())
+                    for _ in statements[1:]:
+                        cur.nextset()
+                        results.append(cur.fetchall())
+            self.commit()
+        return [load(x) for load, x in zip(loaders, results)]
+
+    @contextmanager
+    def _multi_statements(self):
+        """turn on the multi-statements capability of the server for the block"""
+        if self.pool.multi_statements:
+            yield
+            return
+        self._set_server_option(MULTI_STATEMENTS_ON)
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            try:
+                self._set_server_option(MULTI_STATEMENTS_OFF)
+            except Exception:
+                # 关不掉多语句的连接不能放回连接池
+                self._force_close()
+                # 已经出错时抛出原来的异常
+                if success:
+                    raise
+
+    def _set_server_option(self, option):
+        self._execute_command(COMMAND.COM_SET_OPTION, struct.pack(b"<H", option))
+        self._read_packet()
+
     def add(self, obj):
         """
         :param obj: the model object to save
         >>> db.session.add(obj)
         """
-        attr_map = {}
-        for key in obj.keys():
+        with self._release_on_error():
+            con = self._route(obj)
+            if con is self:
+                keys = _table_keys(obj)
+                values = [obj.__map__[k].to_db(obj[k]) for k in keys]
+        if con is not self:
+            return con.add(obj)
+        result = self.do_execute(type(obj).insert_sql(keys), values)
+        identity_map = Db.current_identity_map()
+        if identity_map is not None:
+            identity_map.add(obj)
+        return result
+
+    def add_all(self, objs, batch_size=1000, commit_per_batch=True):
+        """
+        insert many objects with multi-row `INSERT ... VALUES (...),(...)` statements,
+        objects of the same model with the same fields are grouped together,
+        every statement is kept under the server's max_allowed_packet
+        :param objs: the iterable of model objects to save
+        :param batch_size: the max rows of one statement
+        :param commit_per_batch: commit after every statement if True, else commit once at the end
+        :return: (affected rows, generated ids), the ids are in the order of objs,
+                 None if the id can not be known. the ids are computed from the first
+                 id of each statement, so they are only reliable with innodb_autoinc_lock_mode 0 or 1
+        >>> db.session.add_all([User(name="a"), User(name="b")], batch_size=500)
+        """
+        with self._release_on_error():
+            objs = list(objs)
+        routed = self._route_all("add_all", objs, batch_size, commit_per_batch)
+        if routed is not None:
+            affected, ids = 0, [None] * len(objs)
+            for rows, (n, shard_ids) in routed:
+                affected += n
+                for (index, _), id_ in zip(rows, shard_ids):
+                    ids[index] = id_
+            return affected, ids
+        with self._release_on_error():
+            groups, count = _group_objects(objs)
+        ids = [None] * count
+        affected = 0
+        with self as cur:
+            max_packet, increment = self.server_limits(cur)
+            for (model, keys), rows in groups.iteritems():
+                head = model.insert_head(keys)
+                # 只有单一主键且没有赋值时才能得到自增id
+                auto_id = len(model.__primary_key__) == 1 and \
+                    model.__db_map__[model.__primary_key__[0]] not in keys
+                render = self._values_render(model, keys)
+                for values, indexes in _batches(rows, render, _byte_size(head), batch_size, max_packet):
+                    affected += self._execute(cur, head + ",".join(values))
+                    if auto_id and cur.lastrowid:
+                        for i, index in enumerate(indexes):
+                            ids[index] = cur.lastrowid + i * increment
+                    if commit_per_batch:
+                        self.commit()
+            if not commit_per_batch:
+                self.commit()
+        self._after_write(groups.itervalues())
+        return affected, ids
+
+    def upsert_all(self, objs, update_fields=None, batch_size=1000, commit_per_batch=True):
+        """
+        insert many objects and update the rows which already exist, with multi-row
+        `INSERT ... ON DUPLICATE KEY UPDATE` statements grouped and chunked like add_all
+        :param objs: the iterable of model objects to save
+        :param update_fields: the attrs to update when the row exists,
+                              default all the saved attrs except the primary key
+        :param batch_size: the max rows of one statement
+        :param commit_per_batch: commit after every statement if True, else commit once at the end
+        :return: affected rows, mysql counts 1 for an inserted row and 2 for an updated row
+        >>> db.session.upsert_all(users, update_fields=["name"])
+        """
+        with self._release_on_error():
+            objs = list(objs)
+        routed = self._route_all("upsert_all", objs, update_fields, batch_size, commit_per_batch)
+        if routed is not None:
+            return sum([n for _, n in routed])
+        with self._release_on_error():
+            groups, _ = _group_objects(objs)
+        affected = 0
+        with self as cur:
+            max_packet, _ = self.server_limits(cur)
+            for (model, keys), rows in groups.iteritems():
+                head = model.insert_head(keys)
+                if update_fields is None:
+                    fields = [k for k in keys if not model.__map__[k].primary_key]
+                else:
+                    # 没有插入的字段不能更新
+                    fields = [k for k in update_fields if k in keys]
+                tail = model.upsert_tail(tuple(fields))
+                render = self._values_render(model, keys)
+                size = _byte_size(head) + _byte_size(tail)
+                for values, _ in _batches(rows, render, size, batch_size, max_packet):
+                    affected += self._execute(cur, head + ",".join(values) + tail)
+                    if commit_per_batch:
+                        self.commit()
+            if not commit_per_batch:
+                self.commit()
+        self._after_write(groups.itervalues())
+        return affected
+
+    def update_all(self, objs, fields=None, batch_size=1000, commit_per_batch=True):
+        """
+        update many objects by primary key with one statement per batch:
+        `UPDATE t SET f=CASE pk WHEN 1 THEN 'a' WHEN 2 THEN 'b' ELSE f END WHERE pk IN (1,2)`
+        :param objs: the iterable of model objects to update
+        :param fields: the attrs to update, default all the attrs except the primary key,
+                       the column keeps its value when an object has no value for the attr
+        :param batch_size: the max rows of one statement
+        :param commit_per_batch: commit after every statement if True, else commit once at the end
+        :return: affected rows
+        >>> db.session.update_all(users, fields=["name"])
+        """
+        with self._release_on_error():
+            objs = list(objs)
+        routed = self._route_all("update_all", objs, fields, batch_size, commit_per_batch)
+        if routed is not None:
+            return sum([n for _, n in routed])
+        groups = OrderedDict()
+        for index, obj in enumerate(objs):
+            groups.setdefault(type(obj), []).append((index, obj))
+        affected = 0
+        with self as cur:
+            max_packet, _ = self.server_limits(cur)
+            for model, rows in groups.iteritems():
+                attrs = [k for k in (fields or model.__columns__)
+                         if k in model.__map__ and not model.__map__[k].primary_key]
+                if not attrs:
+                    continue
+                if len(model.__primary_key__) == 1:
+                    key = "`%s`" % model.__primary_key__[0]
+                    case, when = "CASE %s " % key, "WHEN %s THEN %s"
+                else:
+                    key = "(%s)" % ",".join(["`%s`" % x for x in model.__primary_key__])
+                    case, when = "CASE ", "WHEN " + key + "=%s THEN %s"
+                render = self._update_render(model, attrs)
+                head = "UPDATE %s SET  WHERE %s IN ()" % (model.__tablename__, key)
+                for values, _ in _batches(rows, render, _byte_size(head), batch_size, max_packet):
+                    sets = []
+                    for i, attr in enumerate(attrs):
+                        whens = [when % (pk, row[i]) for pk, row in values if row[i] is not None]
+                        if whens:
+                            column = "`%s`" % model.__map__[attr].name
+                            sets.append("%s=%s%s ELSE %s END" % (column, case, " ".join(whens), column))
+                    if not sets:
+                        continue
+                    affected += self._execute(cur, "UPDATE %s SET %s WHERE %s IN (%s)" % (
+                        model.__tablename__, ",".join(sets), key, ",".join([pk for pk, _ in values])))
+                    if commit_per_batch:
+                        self.commit()
+            if not commit_per_batch:
+                self.commit()
+        self._after_write(groups.itervalues(), update=True)
+        return affected
+
+    def load(self, model, rows, fields=None, chunk_size=100000, duplicates=None, commit_per_chunk=True):
+        """
+        bulk load rows with `LOAD DATA LOCAL INFILE`, the rows are serialized to tab-separated
+        lines on the fly and streamed to the server, no temp file is written.
+        the server can not read any local file, only the rows are sent
+        :param model: the model class
+        :param rows: the iterable of model objects, or tuples of values in the order of fields
+        :param fields: the attrs to load, default the attrs of the first object, or all the columns for tuples
+        :param chunk_size: the max rows of one LOAD DATA statement
+        :param duplicates: None(error), "replace" or "ignore", how to handle rows with duplicate keys
+        :param commit_per_chunk: commit after every statement if True, else commit once at the end
+        :return: {"rows": loaded rows, "skipped": skipped rows, "warnings": the count of warnings,
+                  "messages": [(level, code, message)] of the first warnings of every statement}
+        >>> db.session.load(User, ((x, "user%s" % x) for x in xrange(10 ** 7)), fields=["id_", "name"])
+        """
+        result = {"rows": 0, "skipped": 0, "warnings": 0, "messages": []}
+        with self._release_on_error():
+            if model.__shard_key__ is not None and Db.get_shards() is not None:
+                raise Exception("load does not support sharded models, load every shard separately")
+            if duplicates not in (None, "replace", "ignore"):
+                raise Exception("duplicates should be None, replace or ignore")
+            rows = iter(rows)
+            first = next(rows, None)
+            if first is not None:
+                rows = chain([first], rows)
+                if fields is None:
+                    keys = model.__columns__ if isinstance(first, (tuple, list)) else _table_keys(first)
+                else:
+                    keys = tuple([x if isinstance(x, basestring) else x.attr for x in fields])
+                render = _tsv_render(model, keys, self.encoding)
+                sql = model.load_sql(keys, duplicates, self.charset)
+        if first is None:
+            self.release()
+            return result
+        profiler = Db.get_profiler()
+        with self as cur:
+            for head in rows:
+                start = time.time()
+                ok = self._load_data(sql, (render(x) for x in chain([head], islice(rows, chunk_size - 1))))
+                if profiler is not None:
+                    profiler.observe(sql, time.time() - start, ok.affected_rows)
+                result["rows"] += ok.affected_rows
+                result["warnings"] += ok.warning_count
+                skipped = SKIPPED_PATTERN.search(ok.message)
+                if skipped:
+                    result["skipped"] += int(skipped.group(1))
+                if ok.warning_count:
+                    cur.execute("SHOW WARNINGS")
+                    result["messages"].extend([(x["Level"], x["Code"], x["Message"]) for x in cur.fetchall()])
+                if commit_per_chunk:
+                    self.commit()
+            if not commit_per_chunk:
+                self.commit()
+        Db.written([model.__tablename__])
+        return result
+
+    def _load_data(self, sql, lines, packet_size=64 * 1024):
+        """
+        send a LOAD DATA LOCAL statement and answer the server's file request with lines
+        :return: the OKPacketWrapper of the statement
+        """
+        self._execute_command(COMMAND.COM_QUERY, sql)
+        packet = self._read_packet()
+        if not packet.is_load_local_packet():
+            raise Exception("the server does not ask for the data, is local_infile enabled ?")
+        buf, size = [], 0
+        try:
+            for line in lines:
+                buf.append(line)
+                size += len(line)
+                if size >= packet_size:
+                    self.write_packet(b"".join(buf))
+                    buf, size = [], 0
+            if buf:
+                self.write_packet(b"".join(buf))
+        except Exception:
+            exc = sys.exc_info()
+            # 结束这条语句，保证连接还可以使用，已经发送的数据由调用者回滚
+            self.write_packet(b"")
+            try:
+                self._read_packet()
+            except Exception:
+                pass
+            raise exc[0], exc[1], exc[2]
+        self.write_packet(b"")
+        ok = OKPacketWrapper(self._read_packet())
+        self.server_status = ok.server_status
+        return ok
+
+    def _route(self, obj):
+        """
+        the connection of the shard which obj belongs to, self when obj is not sharded,
+        self is put back into the pool when another connection is returned
+        """
+        shards = Db.get_shards()
+        if shards is None or type(obj).__shard_key__ is None:
+            return self
+        pool = shards.pool_of(obj)
+        if pool is self.pool:
+            return self
+        if self.transaction_depth > 0:
+            raise Exception("sharded models can not be written in db.transaction()")
+        con = pool.session
+        self.release()
+        return con
+
+    def _route_all(self, name, objs, *args):
+        """
+        split objs by shard and call the method on the connection of every shard,
+        objs of models which are not sharded use self
+        :return: [(rows of the shard [(index, obj)], the result of the method)],
+                 None when no obj is sharded
+        """
+        shards = Db.get_shards()
+        if shards is None or not [x for x in objs if type(x).__shard_key__ is not None]:
+            return None
+        parts = OrderedDict()
+        with self._release_on_error():
+            if self.transaction_depth > 0:
+                raise Exception("sharded models can not be written in db.transaction()")
+            for index, obj in enumerate(objs):
+                pool = shards.pool_of(obj) if type(obj).__shard_key__ is not None else self.pool
+                parts.setdefault(pool, []).append((index, obj))
+        if list(parts) == [self.pool]:
+            return None
+        # self的分片最后写，它的调用会把self放回连接池，之后不能再归还
+        own = parts.pop(self.pool, None)
+        results = []
+        with self._release_on_error():
+            for pool, rows in parts.iteritems():
+                con = pool.session
+                results.append((rows, getattr(con, name)([x for _, x in rows], *args)))
+        if own is None:
+            self.release()
+        else:
+            results.append((own, getattr(self, name)([x for _, x in own], *args)))
+        return results
+
+    def _values_render(self, model, keys):
+        """render an obj to `(v1,v2)` for multi-row INSERT, the values are escaped by the driver"""
+        def render(obj):
+            value = "(%s)" % ",".join([self.literal(model.__map__[k].to_db(obj[k])) for k in keys])
+            return value, _byte_size(value) + 1
+        return render
+
+    def _update_render(self, model, attrs):
+        """render an obj to (primary key literal, [literal of every attr or None if not set])"""
+        pk_attrs = [model.__db_map__[x] for x in model.__primary_key__]
+
+        def render(obj):
             try:
-                attr_map[key] = obj.__map__[key]
+                pk = [self.literal(model.__map__[k].to_db(obj[k])) for k in pk_attrs]
             except KeyError as e:
-                msg = "{} has no a filed named {}".format(obj.__tablename__, e)
-                warnings.warn(msg, SyntaxWarning)
-        fileds = []
-        values = []
-        for k, v in attr_map.iteritems():
-            fileds.append(wrapper_str(obj.__map__[k].name, "`"))
-            values.append(v.connect_str(obj[k]))
-        sql = "INSERT INTO %s (%s) VALUES (%s) " % (
-            obj.__tablename__,
-            ",".join(fileds),
-            ",".join(values))
-        return self.do_execute(sql)
+                raise Exception("{} has no value of primary key {}".format(model.__tablename__, e))
+            pk = pk[0] if len(pk) == 1 else "(%s)" % ",".join(pk)
+            row = []
+            size = _byte_size(pk) + 1
+            for k in attrs:
+                try:
+                    v = self.literal(model.__map__[k].to_db(obj[k]))
+                except KeyError:
+                    v = None
+                else:
+                    # 每个值都要带上一次主键
+                    size += _byte_size(v) + _byte_size(pk) + 20
+                row.append(v)
+            return (pk, row), size
+        return render
+
+    def _after_write(self, groups, update=False):
+        """
+        keep the read pin, the query cache and the identity map up to date after batch writes
+        :param update: the objs only carry the updated values, merge them into the cached objects
+        """
+        groups = list(groups)
+        Db.written([type(obj).__tablename__ for rows in groups for _, obj in rows[:1]])
+        identity_map = Db.current_identity_map()
+        if identity_map is not None:
+            for rows in groups:
+                for _, obj in rows:
+                    if update:
+                        identity_map.update(obj, dict([(k, obj[k]) for k in obj.keys()
+                                                       if k in obj.__map__ and not obj.__map__[k].primary_key]))
+                    else:
+                        identity_map.add(obj)
+
+    def server_limits(self, cur):
+        """
+        get (max_allowed_packet, auto_increment_increment) of the server,
+        the result is cached on the connection
+        """
+        if self._server_limits is None:
+            cur.execute("SELECT @@max_allowed_packet AS max_allowed_packet, "
+                        "@@auto_increment_increment AS auto_increment_increment")
+            row = cur.fetchone()
+            # 留一些余量给包头
+            max_packet = min(int(row["max_allowed_packet"]), self.max_allowed_packet) - 1024
+            self._server_limits = (max_packet, int(row["auto_increment_increment"]))
+        return self._server_limits
 
     def update(self, obj, **kwargs):
         """
@@ -81,41 +617,253 @@ class WrapperConnection(Connection):
         :param kwargs: the updated attr
         >>> db.session.update(obj, id=100, name="haihui")
         """
-        updates = []
-        for k, v in kwargs.iteritems():
-            if k in obj.__map__:
-                updates.append(obj.__map__[k].name + "=" + obj.__map__[k].connect_str(v))
-        if not updates:
+        with self._release_on_error():
+            keys = tuple(sorted([k for k in kwargs if k in obj.__map__]))
+            shards = Db.get_shards()
+            if keys and obj.__primary_key__ and shards is not None and obj.__shard_key__ in keys and \
+                    shards.pool_for(type(obj), kwargs[obj.__shard_key__]) is not shards.pool_of(obj):
+                raise Exception("can not move a record to another shard by updating the shard key")
+        if not keys:
+            self.release()
             return False
-        sql = "UPDATE %s SET %s WHERE " % (obj.__tablename__, ",".join(updates))
-        # 根据主键设置过滤条件
-        wheres = []
-        for key in obj.__primary_key__:
-            wheres.append(key + "=" + obj.__map__[obj.__db_map__[key]].connect_str(obj[obj.__db_map__[key]]))
-        if not wheres:
+        if not obj.__primary_key__:
+            self.release()
             return 0
-        sql += " AND ".join(wheres)
-        return self.do_execute(sql)
+        with self._release_on_error():
+            con = self._route(obj)
+            if con is self:
+                values = [obj.__map__[k].to_db(kwargs[k]) for k in keys]
+                # 根据主键设置过滤条件
+                for key in obj.__primary_key__:
+                    attr = obj.__db_map__[key]
+                    values.append(obj.__map__[attr].to_db(obj[attr]))
+        if con is not self:
+            return con.update(obj, **kwargs)
+        result = self.do_execute(type(obj).update_sql(keys), values)
+        identity_map = Db.current_identity_map()
+        if identity_map is not None:
+            identity_map.update(obj, dict([(k, kwargs[k]) for k in keys]))
+        return result
 
-    def do_execute(self, sql):
+    def _execute(self, cur, sql, args=None):
+        """cur.execute, recorded by the profiler after db.setup_profiler"""
+        profiler = Db.get_profiler()
+        if profiler is None:
+            return cur.execute(sql, args)
+        start = time.time()
+        result = cur.execute(sql, args)
+        profiler.observe(sql, time.time() - start, result)
+        return result
+
+    def do_execute(self, sql, args=None):
         with self as cur:
-            result = cur.execute(sql)
+            result = self._execute(cur, sql, args)
             self.commit()
+        table = write_table(sql)
+        Db.written([table] if table else [])
         return result
 
 
+def _group_objects(objs):
+    """
+    group the objects by (model, sorted table attrs)
+    :return: (OrderedDict of (model, keys) -> [(index, obj)], the count of objs)
+    """
+    groups = OrderedDict()
+    count = 0
+    for obj in objs:
+        groups.setdefault((type(obj), _table_keys(obj)), []).append((count, obj))
+        count += 1
+    return groups, count
+
+
+def _batches(rows, render, head_size, batch_size, max_packet):
+    """
+    render the rows and split them into batches, every batch has at most batch_size rows
+    and the size of its sql is kept under max_packet
+    :param rows: [(index, obj)]
+    :param render: render(obj) -> (value, size of the value in sql)
+    :return: the generator of (values, indexes)
+    """
+    values, indexes, size = [], [], head_size
+    for index, obj in rows:
+        value, value_size = render(obj)
+        if indexes and (len(indexes) >= batch_size or size + value_size > max_packet):
+            yield values, indexes
+            values, indexes, size = [], [], head_size
+        values.append(value)
+        indexes.append(index)
+        size += value_size
+    if indexes:
+        yield values, indexes
+
+
+def _table_keys(obj):
+    """the sorted attrs of obj which are mapped to table fields"""
+    keys = []
+    for key in obj.keys():
+        if key in obj.__map__:
+            keys.append(key)
+        else:
+            msg = "{} has no a filed named {}".format(obj.__tablename__, key)
+            warnings.warn(msg, SyntaxWarning)
+    return tuple(sorted(keys))
+
+
+def run_parallel(funcs, max_workers=None):
+    """
+    在最多max_workers个线程里并发地执行funcs
+    :return: [(返回值, 异常的sys.exc_info())]，和funcs的顺序一致，没有异常时是None
+    >>> run_parallel([lambda: 1, lambda: 1 / 0])
+    [(1, None), (None, (ZeroDivisionError, ..., ...))]
+    """
+    funcs = list(funcs)
+    results = [None] * len(funcs)
+    tasks = Queue.Queue()
+    for item in enumerate(funcs):
+        tasks.put(item)
+
+    def work():
+        while True:
+            try:
+                index, func = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = (func(), None)
+            except Exception:
+                results[index] = (None, sys.exc_info())
+    workers = min(len(funcs), max_workers or len(funcs))
+    if workers <= 1:
+        work()
+        return results
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _tsv_escape(v):
+    """LOAD DATA默认的转义"""
+    if b"\\" in v:
+        v = v.replace(b"\\", b"\\\\")
+    for c, escaped in ((b"\t", b"\\t"), (b"\n", b"\\n"), (b"\r", b"\\r"), (b"\0", b"\\0")):
+        if c in v:
+            v = v.replace(c, escaped)
+    return v
+
+
+def _tsv_render(model, keys, encoding):
+    """
+    render an obj or a tuple of values to a tab-separated line for LOAD DATA,
+    the values are converted by the fields' to_db, None is \\N
+    """
+    fields = [model.__map__[k] for k in keys]
+
+    def value(field, v):
+        if v is None:
+            return b"\\N"
+        v = field.to_db(v)
+        if isinstance(v, unicode):
+            v = v.encode(encoding)
+        elif isinstance(v, bool):
+            v = b"1" if v else b"0"
+        elif isinstance(v, float):
+            v = repr(v)
+        elif not isinstance(v, bytes):
+            v = unicode(v).encode(encoding)
+        return _tsv_escape(v)
+
+    def render(row):
+        if isinstance(row, (tuple, list)):
+            values = row
+        else:
+            values = []
+            for k in keys:
+                try:
+                    values.append(row[k])
+                except KeyError:
+                    values.append(None)
+        return b"\t".join([value(f, v) for f, v in zip(fields, values)]) + b"\n"
+    return render
+
+
+def _byte_size(s):
+    """the size of the string when sent to server"""
+    if isinstance(s, unicode):
+        return len(s.encode("utf-8"))
+    return len(s)
+
+
+class PoolMetrics(object):
+    """
+    连接池的统计数据
+    :param callback: 每次记录时调用callback(name, value)，可以用来导出到监控系统
+    """
+    COUNTERS = ("created", "recycled", "closed", "failed", "timeouts", "broken")
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        # 获取连接等待的秒数
+        self.checkout_wait = Histogram()
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+        if self.callback:
+            self.callback(name, n)
+
+    def observe_wait(self, seconds):
+        with self.lock:
+            self.checkout_wait.observe(seconds)
+        if self.callback:
+            self.callback("checkout_wait", seconds)
+
+    def snapshot(self):
+        with self.lock:
+            result = dict(self.counters)
+            result["checkout_wait"] = self.checkout_wait.snapshot()
+        return result
+
+
+class PoolTimeout(Exception):
+    """连接都被占用，等待超时"""
+
+
 class Pool(object):
     """
     一个基于pymysql的连接池
-    :param pool_max_size:  连接池最大的容量， 默认为5
+    :param pool_max_size:  连接池最大的容量，也是同时打开的连接数的上限， 默认为5
     :param max_life_time:  连接最大的存活时间，以秒为单位，默认是3600，如果超过了时间自动断开
-    :param try_times: 获取连接最大的尝试次数 默认是三次
+    :param try_times: 创建连接最大的尝试次数 默认是三次
+    :param min_idle: 启动时在后台预先打开的连接数，默认为0
+    :param timeout: 连接都被占用时等待归还的秒数，None表示一直等待，默认是30
+    :param max_overflow: 连接都被占用时允许额外打开的连接数，这些连接归还时直接关闭，默认为0
+    :param metrics_callback: 统计数据的回调函数callback(name, value)，见PoolMetrics
+    :param on_broken: 有连接断开时调用on_broken(pool)，ReplicaSet用来摘除从库
+    :param multi_statements: 连接是否一直允许一次执行多条语句，默认只在pipeline里面临时打开，
+                             避免通过原生sql注入叠加的语句
     """
 
     def __init__(self, host="127.0.0.1", port=3306, user="root",
                  password="", db="", charset="utf8mb4",
-                 pool_max_size=5, max_life_time=3600, try_times=3):
-        self.pool = Queue(maxsize=pool_max_size)
+                 pool_max_size=5, max_life_time=3600, try_times=3,
+                 min_idle=0, timeout=30, max_overflow=0, metrics_callback=None, on_broken=None,
+                 multi_statements=False):
+        self.metrics = PoolMetrics(metrics_callback)
+        self.on_broken = on_broken
+        self.multi_statements = multi_statements
+        # 空闲的连接，后进先出，保证常用的连接一直是热的
+        self.idle = []
+        # 已经打开的连接数，不包括overflow的连接
+        self.size = 0
+        self.overflow = 0
+        self.cond = threading.Condition()
         self.host = host
         self.port = port
         self.user = user
@@ -127,46 +875,188 @@ class Pool(object):
         if try_times <= 0:
             try_times = 2
         self.try_times = try_times
+        self.min_idle = min(min_idle, pool_max_size)
+        self.timeout = timeout
+        self.max_overflow = max_overflow
+        if self.min_idle > 0:
+            self._prewarm()
+
+    def _create(self, overflow=False):
+        """新建连接，失败时返回None"""
+        for _ in range(self.try_times):
+            try:
+                con = WrapperConnection(
+                    host=self.host,
+                    user=self.user,
+                    password=self.password,
+                    db=self.db,
+                    port=self.port,
+                    charset=self.charset,
+                    max_life_time=self.max_life_time,
+                    cursorclass=DictCursor, pool=self,
+                    overflow=overflow,
+                    # load需要LOAD DATA LOCAL，但是没有打开local_infile，服务器不能读取本地的文件
+                    client_flag=CLIENT.LOCAL_FILES | (CLIENT.MULTI_STATEMENTS if self.multi_statements else 0))
+                self.metrics.incr("created")
+                return con
+            except Exception as e:
+                self.metrics.incr("failed")
+        return None
+
+    def _prewarm(self):
+        """在后台线程中打开min_idle个连接"""
+        def fill():
+            while True:
+                with self.cond:
+                    if self.size >= self.min_idle:
+                        return
+                    self.size += 1
+                con = self._create()
+                with self.cond:
+                    if con is None:
+                        self.size -= 1
+                        return
+                    con.checked_out = False
+                    self.idle.append(con)
+                    self.cond.notify()
+        thread = threading.Thread(target=fill)
+        thread.daemon = True
+        thread.start()
 
     @property
     def connection(self):
+        return self.checkout(self.timeout)
+
+    def checkout(self, timeout):
         """
-        基本的算法是先从pool里面去取连接，如果取到，判断有没有超时， 
-        如果超时，重新获取，否则返回。如果没取到，重新连接数据库获取连接
+        基本的算法是先从空闲连接里后进先出地取连接，过期的连接直接关闭。
+        没有空闲连接时，如果打开的连接数没有达到上限就新建连接，
+        否则打开overflow连接或者等待其他线程归还，超过timeout抛出异常
+        :param timeout: 等待归还的秒数，None表示一直等待
         """
-        try_times = self.try_times
+        start = time.time()
+        deadline = None if timeout is None else start + timeout
+        dead = []
+        overflow = False
         try:
-            while try_times > 0:
-                con = self.pool.get(block=False)
-                if not con.is_dead:
-                    return con
-                try_times -= 1
-        except Empty as e:
-            try:
-                while try_times > 0:
-                    con = WrapperConnection(
-                        host=self.host,
-                        user=self.user,
-                        password=self.password,
-                        db=self.db,
-                        port=self.port,
-                        charset=self.charset,
-                        max_life_time=self.max_life_time,
-                        cursorclass=DictCursor, pool=self)
-                    return con
-            except Exception as e:
-                try_times -= 1
-        return None
+            with self.cond:
+                while True:
+                    if self.idle:
+                        con = self.idle.pop()
+                        if con.is_dead:
+                            self.size -= 1
+                            dead.append(con)
+                            continue
+                        con.checked_out = True
+                        break
+                    con = None
+                    if self.size < self.pool_max_size:
+                        self.size += 1
+                        break
+                    if self.overflow < self.max_overflow:
+                        self.overflow += 1
+                        overflow = True
+                        break
+                    if deadline is None:
+                        self.cond.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.metrics.incr("timeouts")
+                        raise PoolTimeout("get connection timeout after %s seconds" % timeout)
+                    self.cond.wait(remaining)
+        finally:
+            for x in dead:
+                self.metrics.incr("recycled")
+                self._close(x)
+        if con is None:
+            con = self._create(overflow)
+            if con is None:
+                with self.cond:
+                    if overflow:
+                        self.overflow -= 1
+                    else:
+                        self.size -= 1
+                    self.cond.notify()
+                return None
+        self.metrics.observe_wait(time.time() - start)
+        return con
 
     def put(self, connection):
-        try:
-            if not connection.is_dead:
-                self.pool.put_nowait(connection)
+        with self.cond:
+            # 同一个连接可能被归还多次
+            if not connection.checked_out:
+                return
+            connection.checked_out = False
+            close = True
+            recycled = False
+            if connection.overflow:
+                self.overflow -= 1
+            elif connection.is_dead:
+                self.size -= 1
+                recycled = True
+            else:
+                self.idle.append(connection)
+                close = False
+            self.cond.notify()
+        if recycled:
+            self.metrics.incr("recycled")
+        if close:
+            self._close(connection)
+
+    def discard(self, connection):
+        """关闭断开的连接，不放回空闲连接"""
+        with self.cond:
+            if not connection.checked_out:
+                return
+            connection.checked_out = False
+            if connection.overflow:
+                self.overflow -= 1
             else:
-                # try to close
-                connection.close()
+                self.size -= 1
+            self.cond.notify()
+        self.metrics.incr("broken")
+        self._close(connection)
+        if self.on_broken is not None:
+            self.on_broken(self)
+
+    def close_idle(self):
+        """关闭所有空闲的连接，服务器不可用时这些连接大多已经断开"""
+        with self.cond:
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+            self.cond.notify_all()
+        for con in idle:
+            self._close(con)
+
+    def _close(self, connection):
+        """try to close the connection"""
+        self.metrics.incr("closed")
+        try:
+            connection.close()
         except Exception as e:
-            raise Exception("put into pool error happens")
+            pass
+
+    def stats(self):
+        """
+        连接池统计数据的快照
+        >>> db.get_pool().stats()
+        {"created": 5, "recycled": 1, "closed": 1, "failed": 0, "timeouts": 0,
+         "checkout_wait": {"count": 100, "sum": 0.5, "max": 0.1, "buckets": [...]},
+         "idle": 3, "in_use": 2, "overflow": 0, "size": 5}
+        """
+        result = self.metrics.snapshot()
+        with self.cond:
+            result["idle"] = len(self.idle)
+            result["size"] = self.size
+            result["overflow"] = self.overflow
+            result["in_use"] = self.in_use
+        return result
+
+    @property
+    def in_use(self):
+        """被占用的连接数"""
+        return self.size + self.overflow - len(self.idle)
 
     @property
     def session(self):
@@ -184,7 +1074,13 @@ MYSQL_CONNECTION_ARGS = {"OR_MYSQL_HOST": str,
                          "OR_MYSQL_CHARSET": str,
                          "OR_MYSQL_MAX_POOL_SIZE": int,
                          "OR_MYSQL_MAX_LIFE_TIME": int,
-                         "OR_MYSQL_TRY_TIMES": int
+                         "OR_MYSQL_TRY_TIMES": int,
+                         "OR_MYSQL_MIN_IDLE": int,
+                         "OR_MYSQL_TIMEOUT": float,
+                         "OR_MYSQL_MAX_OVERFLOW": int,
+                         "OR_MYSQL_REPLICAS": str,
+                         "OR_MYSQL_READ_STRATEGY": str,
+                         "OR_MYSQL_PIN_SECONDS": float
                          }
 
 MYSQL_CONNECTION_ARGS_TRANS = {"OR_MYSQL_HOST": "host",
@@ -195,13 +1091,22 @@ MYSQL_CONNECTION_ARGS_TRANS = {"OR_MYSQL_HOST": "host",
                                "OR_MYSQL_CHARSET": "charset",
                                "OR_MYSQL_MAX_POOL_SIZE": "pool_max_size",
                                "OR_MYSQL_MAX_LIFE_TIME": "max_life_time",
-                               "OR_MYSQL_TRY_TIMES": "try_times"
+                               "OR_MYSQL_TRY_TIMES": "try_times",
+                               "OR_MYSQL_MIN_IDLE": "min_idle",
+                               "OR_MYSQL_TIMEOUT": "timeout",
+                               "OR_MYSQL_MAX_OVERFLOW": "max_overflow",
+                               "OR_MYSQL_REPLICAS": "replicas",
+                               "OR_MYSQL_READ_STRATEGY": "read_strategy",
+                               "OR_MYSQL_PIN_SECONDS": "pin_seconds"
                                }
 
+# 读写分离的参数，不是连接池的参数
+READ_ARGS = ("replicas", "read_strategy", "pin_seconds")
 
-def get_db():
+
+def get_connect_args():
     """
-    获取数据库连接对象，首先从环境变量里获取连接参数，
+    获取连接参数，首先从环境变量里获取，
     如果没有获取到，从本目录下面的env文件中获取
     """
     connect_args = {}
@@ -225,40 +1130,552 @@ def get_db():
     trans_connect_args = {}
     for k, v in connect_args.iteritems():
         trans_connect_args[MYSQL_CONNECTION_ARGS_TRANS[k]] = v
-    if not trans_connect_args:
+    return trans_connect_args
+
+
+def get_db(connect_args=None):
+    """获取主库的连接池"""
+    if connect_args is None:
+        connect_args = get_connect_args()
+    pool_args = dict([(k, v) for k, v in connect_args.iteritems() if k not in READ_ARGS])
+    if not pool_args:
         warnings.warn("you need set up the environments to connect to mysql", RuntimeWarning)
         return None
-    return Pool(**trans_connect_args)
+    return Pool(**pool_args)
+
+
+def get_replicas(pool, connect_args):
+    """
+    获取从库的连接池，OR_MYSQL_REPLICAS的格式是host:port:weight,host:port:weight，
+    port和weight可以省略，其他的参数和主库一致
+    """
+    spec = connect_args.get("replicas")
+    if pool is None or not spec:
+        return None
+    replicas = []
+    for item in spec.split(","):
+        parts = item.strip().split(":")
+        replica = {"host": parts[0]}
+        if len(parts) > 1 and parts[1]:
+            replica["port"] = int(parts[1])
+        if len(parts) > 2 and parts[2]:
+            replica["weight"] = int(parts[2])
+        replicas.append(replica)
+    return ReplicaSet.from_primary(pool, replicas, connect_args.get("read_strategy", "weighted"))
+
+
+class ReplicaSet(object):
+    """
+    从库的连接池集合，读请求按权重(weighted)或者最少未完成请求数(least_outstanding)分发，
+    创建连接失败或者有连接断开的从库会被摘除eject_seconds秒，
+    连接都被占用的从库等待checkout_timeout秒之后换其他的从库，都不可用时读主库
+    :param pools: [(pool, weight)]
+    :param strategy: weighted或者least_outstanding
+    :param eject_seconds: 摘除的秒数
+    :param checkout_timeout: 从一个从库获取连接最多等待的秒数
+    """
+    STRATEGIES = ("weighted", "least_outstanding")
+
+    def __init__(self, pools, strategy="weighted", eject_seconds=30, checkout_timeout=1):
+        if strategy not in self.STRATEGIES:
+            raise Exception("read strategy should be one of %s" % ",".join(self.STRATEGIES))
+        self.pools = list(pools)
+        self.strategy = strategy
+        self.eject_seconds = eject_seconds
+        self.checkout_timeout = checkout_timeout
+        # id(pool) -> 摘除到什么时候
+        self.ejected = {}
+        for pool, _ in self.pools:
+            pool.on_broken = self.eject
+
+    @classmethod
+    def from_primary(cls, primary, replicas, strategy="weighted", eject_seconds=30, checkout_timeout=1):
+        """
+        除了replicas里面指定的参数，其他参数和主库一致
+        :param replicas: [{"host": "10.0.0.2", "port": 3306, "weight": 2}]
+        """
+        pools = []
+        for replica in replicas:
+            args = {"host": primary.host, "port": primary.port, "user": primary.user,
+                    "password": primary.password, "db": primary.db, "charset": primary.charset,
+                    "pool_max_size": primary.pool_max_size, "max_life_time": primary.max_life_time,
+                    "try_times": primary.try_times, "min_idle": primary.min_idle,
+                    "timeout": primary.timeout, "max_overflow": primary.max_overflow,
+                    "multi_statements": primary.multi_statements}
+            args.update(replica)
+            weight = args.pop("weight", 1)
+            pools.append((Pool(**args), weight))
+        return cls(pools, strategy, eject_seconds, checkout_timeout)
+
+    def eject(self, pool):
+        self.ejected[id(pool)] = time.time() + self.eject_seconds
+        # 摘除期间不会使用这些连接，恢复之后重新建立
+        pool.close_idle()
+
+    def available(self):
+        now = time.time()
+        return [(pool, weight) for pool, weight in self.pools
+                if weight > 0 and self.ejected.get(id(pool), 0) <= now]
+
+    def choose(self, candidates):
+        if self.strategy == "least_outstanding":
+            return min(candidates, key=lambda x: x[0].in_use / float(x[1]))[0]
+        point = random.uniform(0, sum([weight for _, weight in candidates]))
+        for pool, weight in candidates:
+            point -= weight
+            if point <= 0:
+                return pool
+        return candidates[-1][0]
+
+    @property
+    def connection(self):
+        """从可用的从库获取连接，都不可用时返回None"""
+        candidates = self.available()
+        while candidates:
+            pool = self.choose(candidates)
+            try:
+                con = pool.checkout(min(self.checkout_timeout, pool.timeout)
+                                    if pool.timeout is not None else self.checkout_timeout)
+            except PoolTimeout:
+                # 从库繁忙不是故障，不摘除
+                con = False
+            if con:
+                return con
+            if con is None:
+                self.eject(pool)
+            candidates = [x for x in candidates if x[0] is not pool]
+        return None
+
+
+def shard_index(value, n):
+    """
+    默认的分片规则，整数取模，其他类型按crc32取模
+    >>> shard_index(10, 4)
+    2
+    >>> shard_index("linghaihui", 4) == shard_index(u"linghaihui", 4)
+    True
+    """
+    if isinstance(value, (int, long)):
+        return value % n
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return (zlib.crc32(str(value)) & 0xffffffff) % n
+
+
+class ShardMap(object):
+    """
+    分片的连接池，设置了__shard_key__的model按分片键的值读写对应的分片
+    :param pools: 每个分片的连接池
+    :param resolver: resolver(value, n)返回分片的序号，默认是shard_index
+    """
+    def __init__(self, pools, resolver=None):
+        if not pools:
+            raise Exception("shards should have at least a pool")
+        self.pools = list(pools)
+        self.resolver = resolver or shard_index
+
+    def pool_for(self, model, value):
+        """model分片键的值是value的记录所在的分片"""
+        value = model.__map__[model.__shard_key__].to_db(value)
+        return self.pools[self.resolver(value, len(self.pools))]
+
+    def pool_of(self, obj):
+        """obj所在的分片"""
+        try:
+            value = obj[obj.__shard_key__]
+        except KeyError:
+            raise Exception("{} has no value of shard key {}".format(obj.__tablename__, obj.__shard_key__))
+        return self.pool_for(type(obj), value)
+
+
+class IdentityMap(object):
+    """
+    一个工作单元内的对象缓存，key是(model类, 主键tuple)，
+    同一个主键的记录在工作单元内只对应一个对象
+    """
+    def __init__(self):
+        self.objects = {}
+
+    @staticmethod
+    def identity(obj):
+        """对象的主键tuple，主键没有赋值时返回None"""
+        try:
+            return tuple([obj[obj.__db_map__[x]] for x in obj.__primary_key__])
+        except KeyError:
+            return None
+
+    def get(self, cls, pk):
+        return self.objects.get((cls, tuple(pk)))
+
+    def add(self, obj):
+        pk = self.identity(obj)
+        if pk is not None:
+            self.objects[(type(obj), pk)] = obj
+
+    def merge(self, obj):
+        """如果已经有同一主键的对象，返回已有的对象，否则放入缓存"""
+        pk = self.identity(obj)
+        if pk is None:
+            return obj
+        return self.objects.setdefault((type(obj), pk), obj)
+
+    def update(self, obj, attrs):
+        """更新缓存中的对象，主键变化时重新放入缓存"""
+        pk = self.identity(obj)
+        if pk is None:
+            return
+        cached = self.objects.pop((type(obj), pk), None)
+        if cached is None:
+            return
+        for k, v in attrs.iteritems():
+            cached[k] = v
+        self.add(cached)
+
+    def clear(self):
+        self.objects.clear()
+
+
+class Transaction(object):
+    """
+    db.transaction()返回的事务，持有一个连接直到事务结束，
+    add/update先放进队列，提交前按表分批写入
+    :param connection: 事务使用的连接
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        # 提交后需要让缓存失效的表
+        self.tables = set()
+        self.adds = []
+        self.updates = []
+
+    def add(self, obj):
+        """放进队列，提交前和其他add一起用add_all写入"""
+        self.adds.append(obj)
+
+    def update(self, obj, **kwargs):
+        """放进队列，提交前同一个表更新同样字段的合并成update_all"""
+        self.updates.append((obj, kwargs))
+
+    def flush(self):
+        """把队列里的写操作分批写入，add在update之前"""
+        adds, self.adds = self.adds, []
+        updates, self.updates = self.updates, []
+        if adds:
+            self.connection.add_all(adds, commit_per_batch=False)
+        batch = OrderedDict()
+        for obj, kwargs in updates:
+            kwargs = dict([(k, v) for k, v in kwargs.iteritems() if k in obj.__map__])
+            if not kwargs:
+                continue
+            if [k for k in kwargs if obj.__map__[k].primary_key]:
+                # 修改主键的不能合并，按顺序执行
+                self._flush_updates(batch)
+                batch.clear()
+                self.connection.update(obj, **kwargs)
+                continue
+            pk = IdentityMap.identity(obj)
+            if pk is None:
+                raise Exception("{} has no value of primary key".format(obj.__tablename__))
+            batch.setdefault((type(obj), pk), {}).update(kwargs)
+        self._flush_updates(batch)
+
+    def _flush_updates(self, batch):
+        groups = OrderedDict()
+        for (model, pk), kwargs in batch.iteritems():
+            values = dict(zip([model.__db_map__[x] for x in model.__primary_key__], pk))
+            values.update(kwargs)
+            groups.setdefault((model, tuple(sorted(kwargs))), []).append(model(**values))
+        for (model, keys), objs in groups.iteritems():
+            self.connection.update_all(objs, fields=keys, commit_per_batch=False)
 
 
 class Db(object):
 
-    _pool = get_db()
+    _connect_args = get_connect_args()
+    _pool = get_db(_connect_args)
+    _replicas = get_replicas(_pool, _connect_args)
+    # 写之后多少秒内的读请求仍然发到主库
+    _pin_seconds = _connect_args.get("pin_seconds", 0)
+    _local = threading.local()
+    _cache = None
+    _shards = None
+    _profiler = None
 
     @Property
     def session(self):
+        transaction = self.current_transaction()
+        if transaction is not None:
+            return transaction.connection
         if not self._pool:
             raise Exception("you need revoke db.setup_db method to setup mysql")
         else:
             pool = self.get_pool()
             return pool.session
 
+    @Property
+    def read_session(self):
+        """
+        读请求的连接，有从库时从从库获取，
+        use_primary里面、写之后的pin_seconds秒内或者从库都不可用时使用主库
+        """
+        if self._replicas is None or self.pinned() or self.current_transaction() is not None:
+            return self.session
+        con = self._replicas.connection
+        if con is None:
+            return self.session
+        return con
+
+    @classmethod
+    def pinned(cls):
+        if getattr(cls._local, "use_primary", 0) > 0:
+            return True
+        return getattr(cls._local, "pin_until", 0) > time.time()
+
+    @classmethod
+    def written(cls, tables):
+        """
+        写之后调用，固定读主库，让这些表的查询缓存失效，事务中在提交之后才失效
+        :param tables: 写的表
+        """
+        cls.mark_written()
+        transaction = cls.current_transaction()
+        if transaction is not None:
+            transaction.tables.update(tables)
+            return
+        cache = cls._cache
+        if cache is not None:
+            for table in tables:
+                cache.invalidate(table)
+
+    @classmethod
+    def current_transaction(cls):
+        return getattr(cls._local, "transaction", None)
+
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        """
+        代码块里面通过db.session的读写都在同一个连接上执行，结束时才提交一次，
+        出现异常时回滚。tx.add/tx.update放进队列，提交前按表分批写入。
+        嵌套时加入外层的事务
+        >>> with db.transaction() as tx:
+        ...     db.session.do_execute("DELETE FROM tt.user WHERE id=1")
+        ...     tx.add(User(name="linghaihui"))
+        ...     tx.update(user, name="haihui")
+        """
+        transaction = cls.current_transaction()
+        if transaction is not None:
+            yield transaction
+            return
+        con = cls.session
+        transaction = Transaction(con)
+        con.transaction_depth += 1
+        cls._local.transaction = transaction
+        try:
+            yield transaction
+            transaction.flush()
+        except BaseException:
+            exc = sys.exc_info()
+            cls._end_transaction(con, transaction, exc[1])
+            raise exc[0], exc[1], exc[2]
+        cls._end_transaction(con, transaction, None)
+
+    @classmethod
+    def _end_transaction(cls, con, transaction, error):
+        """
+        没有异常时提交，否则回滚，然后归还连接，连接断开了就丢弃。
+        回滚失败时不掩盖代码块里原来的异常
+        :param error: 代码块里抛出的异常，None表示成功
+        """
+        cls._local.transaction = None
+        con.transaction_depth -= 1
+        broken = error is not None and is_disconnect(error)
+        try:
+            if error is None:
+                con.commit()
+            else:
+                con.rollback()
+        except Exception as e:
+            broken = broken or is_disconnect(e)
+            if error is None:
+                raise
+        finally:
+            con.release(broken=broken)
+            # 回滚时也让缓存失效
+            cls.written(transaction.tables)
+
+    @classmethod
+    def gather(cls, *queries, **kwargs):
+        """
+        并发地执行多个查询，每个查询在自己的线程里从连接池获取连接，
+        同时执行的查询数不超过连接池的大小。事务里面按顺序在当前线程执行
+        :param queries: Queryer(返回all()的结果)或者没有参数的函数
+        :param max_workers: 最多同时执行的查询数，默认是连接池的大小
+        :return: 每个查询的结果，和queries的顺序一致，出错的查询对应的是它抛出的异常
+        >>> users, count = db.gather(User.query.filter(User.id_ > 10), lambda: User.query.count())
+        """
+        max_workers = kwargs.pop("max_workers", None)
+        if kwargs:
+            raise TypeError("unexpected arguments %s" % ",".join(kwargs))
+        funcs = [x if callable(x) else x.all for x in queries]
+        if cls.current_transaction() is not None:
+            max_workers = 1
+        elif cls._pool is not None:
+            max_workers = min(max_workers or cls._pool.pool_max_size, cls._pool.pool_max_size)
+        # 工作线程沿用当前线程的use_primary、写之后读主库和identity map
+        caller = threading.current_thread()
+        state = dict(cls._local.__dict__)
+
+        def bind(func):
+            def run():
+                if threading.current_thread() is caller:
+                    return func()
+                cls._local.__dict__.update(state)
+                try:
+                    return func()
+                finally:
+                    cls._local.__dict__.clear()
+            return run
+        results = run_parallel([bind(x) for x in funcs], max_workers)
+        return [value if error is None else error[1] for value, error in results]
+
+    @classmethod
+    def mark_written(cls):
+        """记录当前线程的写操作，之后的pin_seconds秒内读主库"""
+        if cls._replicas is not None and cls._pin_seconds:
+            cls._local.pin_until = time.time() + cls._pin_seconds
+
+    @classmethod
+    @contextmanager
+    def use_primary(cls):
+        """
+        在当前线程把读请求固定到主库
+        >>> with db.use_primary():
+        ...     User.get(1)
+        """
+        cls._local.use_primary = getattr(cls._local, "use_primary", 0) + 1
+        try:
+            yield
+        finally:
+            cls._local.use_primary -= 1
+
     @classmethod
     def get_pool(cls):
         return cls._pool
 
+    @classmethod
+    def get_replicas(cls):
+        return cls._replicas
+
+    @classmethod
+    def setup_replicas(cls, replicas, read_strategy="weighted", pin_seconds=0, eject_seconds=30,
+                       checkout_timeout=1):
+        """
+        设置从库
+        :param replicas: [{"host": "10.0.0.2", "port": 3306, "weight": 2}]，没有指定的参数和主库一致
+        :param read_strategy: weighted或者least_outstanding
+        :param pin_seconds: 写之后多少秒内的读请求仍然发到主库
+        :param eject_seconds: 创建连接失败或者有连接断开的从库摘除的秒数
+        :param checkout_timeout: 从库的连接都被占用时等待的秒数，超过之后换其他的从库或者主库
+        """
+        if not replicas:
+            cls._replicas = None
+        else:
+            cls._replicas = ReplicaSet.from_primary(cls._pool, replicas, read_strategy, eject_seconds,
+                                                    checkout_timeout)
+        cls._pin_seconds = pin_seconds
+
     @classmethod
     def set_pool(cls, pool):
         cls._pool = pool
 
+    @classmethod
+    def get_shards(cls):
+        return cls._shards
+
+    @classmethod
+    def setup_shards(cls, shards, resolver=None):
+        """
+        设置分片，设置了__shard_key__的model的add/update/get直接读写所在的分片，
+        不带分片键的查询并发地查询所有分片再归并
+        :param shards: 每个分片的Pool或者创建Pool的参数，None表示取消分片
+        :param resolver: resolver(value, n)返回分片的序号，默认整数取模，其他类型用crc32取模
+        >>> db.setup_shards([{"host": "10.0.0.2"}, {"host": "10.0.0.3"}])
+        """
+        if not shards:
+            cls._shards = None
+            return None
+        pools = [Pool(**x) if isinstance(x, dict) else x for x in shards]
+        cls._shards = ShardMap(pools, resolver)
+        return cls._shards
+
+    @classmethod
+    def get_profiler(cls):
+        return cls._profiler
+
+    @classmethod
+    def setup_profiler(cls, slow_seconds=1.0, logger=None, max_fingerprints=1000):
+        """
+        按fingerprint统计所有sql的次数、耗时的分位数和行数，慢查询记录到日志
+        :param slow_seconds: 慢查询的秒数，None表示不记录慢查询
+        :param logger: 慢查询的logger，默认是orMysql.slow
+        :param max_fingerprints: 最多统计的fingerprint个数
+        >>> profiler = db.setup_profiler(slow_seconds=0.5)
+        >>> profiler.dump(limit=10)
+        """
+        cls._profiler = QueryProfiler(slow_seconds, logger, max_fingerprints)
+        return cls._profiler
+
+    @classmethod
+    def get_cache(cls):
+        return cls._cache
+
+    @classmethod
+    def setup_cache(cls, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        """
+        开启查询结果缓存，只有设置了__cache_ttl__的model会被缓存
+        :param max_entries: 最多缓存的条目数
+        :param max_bytes: 最多占用的内存，以字节为单位
+        """
+        cls._cache = QueryCache(max_entries, max_bytes)
+        return cls._cache
+
+    @classmethod
+    @contextmanager
+    def identity_map(cls):
+        """
+        在当前线程开启identity map，Model.get优先从缓存读取，
+        查询结果按主键去重，add/update会更新缓存。嵌套时沿用外层的缓存
+        >>> with db.identity_map():
+        ...     assert User.get(1) is User.get(1)
+        """
+        identity_map = cls.current_identity_map()
+        if identity_map is not None:
+            yield identity_map
+            return
+        cls._local.identity_map = identity_map = IdentityMap()
+        try:
+            yield identity_map
+        finally:
+            cls._local.identity_map = None
+
+    @classmethod
+    def current_identity_map(cls):
+        return getattr(cls._local, "identity_map", None)
+
     @classmethod
     def setup_db(cls, host="127.0.0.1", port=3306, user="root",
                  password="123456", database="", charset="utf8mb4",
                  pool_max_size=5, max_life_time=3600,
-                 try_times=3):
+                 try_times=3, min_idle=0, timeout=30, max_overflow=0,
+                 metrics_callback=None, replicas=None, read_strategy="weighted",
+                 pin_seconds=0, multi_statements=False):
         pool = Pool(host, port, user, password, database, charset,
-                       pool_max_size, max_life_time, try_times)
+                       pool_max_size, max_life_time, try_times,
+                       min_idle, timeout, max_overflow, metrics_callback,
+                       multi_statements=multi_statements)
         cls.set_pool(pool)
+        cls.setup_replicas(replicas, read_strategy, pin_seconds)
 
 
 db = Db
\ No newline at end of file
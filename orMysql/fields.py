@@ -1,9 +1,51 @@
 # coding=utf-8
 
-from orMysql.utils import wrapper_str
 from datetime import datetime, date
 
 
+# 字段没有赋值
+UNSET = object()
+
+
+class Deferred(object):
+    """没有加载的字段的值的标记基类，子类需要实现load()，访问字段时调用它加载"""
+
+
+class Expression(object):
+    """
+    带参数的sql表达式，值不会拼接进sql，而是作为参数交给驱动转义，
+    多个表达式用&和|组合，参数会按顺序合并
+    :param sql: 使用%s作为占位符的sql片段
+    :param params: 占位符对应的参数
+    >>> e = (Expression("id=%s", [1]) | Expression("name=%s", ["a"])) & Expression("age>%s", [3])
+    >>> e.sql, e.params
+    ('((id=%s OR name=%s) AND age>%s)', [1, 'a', 3])
+    """
+    def __init__(self, sql, params=()):
+        self.sql = sql
+        self.params = list(params)
+
+    def __repr__(self):
+        return self.sql
+
+    def __str__(self):
+        """带参数的表达式拼接成字符串后参数会丢失，只留下%s占位符"""
+        if self.params:
+            raise Exception("expression %s has params, combine it with & or | instead of formatting" % self.sql)
+        return self.sql
+
+    def _combine(self, op, other):
+        if not isinstance(other, Expression):
+            raise Exception("can not combine expression with %r" % (other, ))
+        return Expression("(%s %s %s)" % (self.sql, op, other.sql), self.params + other.params)
+
+    def __and__(self, other):
+        return self._combine("AND", other)
+
+    def __or__(self, other):
+        return self._combine("OR", other)
+
+
 class BaseField(object):
     """
     字段基类
@@ -17,56 +59,105 @@ class BaseField(object):
         self.doc = ""
         self.default = ""
         self.primary_key = primary_key
-    
+
     def __repr__(self):
         return self.name
-    
+
+    def __get__(self, obj, cls):
+        """通过类访问时返回字段本身，通过对象访问时返回字段的值"""
+        if obj is None:
+            return self
+        v = obj.__values__[self.index]
+        if v is UNSET:
+            raise AttributeError(self.attr)
+        if isinstance(v, Deferred):
+            v.load()
+            v = obj.__values__[self.index]
+        return v
+
+    def _compare(self, op, other):
+        # 和另一个字段比较时不需要参数
+        if isinstance(other, BaseField):
+            return Expression(self.name + op + other.name)
+        return Expression(self.name + op + "%s", [self.to_db(other)])
+
     def __eq__(self, other):
-        return self.name + "=" + str(other)
-    
+        return self._compare("=", other)
+
     def __ne__(self, other):
-        return self.name + "!=" + str(other)
+        return self._compare("!=", other)
 
     def __lt__(self, other):
-        return self.name + "<" + str(other)
+        return self._compare("<", other)
 
     def __gt__(self, other):
-        return self.name + ">" + str(other)
-    
+        return self._compare(">", other)
+
     def __le__(self, other):
-        return self.name + "<=" + str(other)
+        return self._compare("<=", other)
 
     def __ge__(self, other):
-        return self.name + ">=" + str(other)
-    
+        return self._compare(">=", other)
+
+    def in_(self, values):
+        values = list(values)
+        if not values:
+            return Expression("1=0")
+        return Expression("%s IN (%s)" % (self.name, ",".join(["%s"] * len(values))),
+                          [self.to_db(x) for x in values])
+
     def like(self, s):
-        return self.name + " LIKE %s " % wrapper_str(s)
-    
+        return Expression(self.name + " LIKE %s", [s])
+
     def desc(self):
         return self.name + " DESC "
 
     def asc(self):
         return self.name + " ASC "
 
+    def count(self):
+        return "COUNT(%s)" % self.name
+
+    def sum(self):
+        return "SUM(%s)" % self.name
+
+    def min(self):
+        return "MIN(%s)" % self.name
+
+    def max(self):
+        return "MAX(%s)" % self.name
+
+    def avg(self):
+        return "AVG(%s)" % self.name
+
     def is_null(self):
-        return self.name + " IS NULL"
+        return Expression(self.name + " IS NULL")
 
     def is_not_null(self):
-        return self.name + " IS NOT NULL"
-    
-    def connect_str(self, v):
-        """和字符串连接时样子"""
-        return str(v)
+        return Expression(self.name + " IS NOT NULL")
+
+    def to_db(self, v):
+        """转换成交给驱动的参数"""
+        return v
 
 
 class IntFiled(BaseField):
     def __init__(self, name="", doc="", default=0, primary_key=False):
         super(IntFiled, self).__init__(
-            name=name, 
-            doc=doc, 
-            default=default, 
+            name=name,
+            doc=doc,
+            default=default,
             primary_key=primary_key)
 
+    def to_db(self, v):
+        """数字的字符串转换成整数，"3"和3作为参数、主键和分片键时是同一个值"""
+        if isinstance(v, basestring):
+            try:
+                return int(v)
+            except ValueError:
+                return v
+        return v
+
 
 class FloatFiled(BaseField):
     def __init__(self, name="", doc="", default=0, primary_key=False):
@@ -89,72 +180,29 @@ class DecimalField(BaseField):
 class StringFiled(BaseField):
     def __init__(self, name="", doc="", default="", primary_key=False):
         super(StringFiled, self).__init__(
-            name=name, 
-            doc=doc, 
-            default=default, 
+            name=name,
+            doc=doc,
+            default=default,
             primary_key=primary_key)
-    
-    def __eq__(self, other):
-        return self.name + "=" + wrapper_str(other)
-    
-    def __ne__(self, other):
-        return self.name + "!=" + wrapper_str(other)
 
-    def __lt__(self, other):
-        return self.name + "<" + wrapper_str(other)
-
-    def __gt__(self, other):
-        return self.name + ">" + wrapper_str(other)
-
-    def __ge__(self, other):
-        return self.name + ">=" + wrapper_str(other)
-
-    def __le__(self, other):
-        return self.name + "<=" + wrapper_str(other)
-    
-    def connect_str(self, v):
-        return wrapper_str(v)
+    def to_db(self, v):
+        """整数转换成字符串，3和"3"作为参数、主键和分片键时是同一个值"""
+        if isinstance(v, (int, long)) and not isinstance(v, bool):
+            return unicode(v)
+        return v
 
 
 class DateTimeFiled(BaseField):
     def __init__(self, name="", doc="", default="", primary_key=False):
         super(DateTimeFiled, self).__init__(
-            name=name, doc=doc, 
-            default=default, 
+            name=name, doc=doc,
+            default=default,
             primary_key=primary_key)
-    
-    def __eq__(self, other):
-        if isinstance(other, datetime):
-            other = other.strftime("%Y-%m-%d %H:%M:%S")
-        return self.name + "=" + wrapper_str(other)
-    
-    def __ne__(self, other):
-        if isinstance(other, datetime):
-            other = other.strftime("%Y-%m-%d %H:%M:%S")
-        return self.name + "!=" + wrapper_str(other)
-
-    def __lt__(self, other):
-        if isinstance(other, datetime):
-            other = other.strftime("%Y-%m-%d %H:%M:%S")
-        return self.name + "<" + wrapper_str(other)
 
-    def __gt__(self, other):
-        if isinstance(other, datetime):
-            other = other.strftime("%Y-%m-%d %H:%M:%S")
-        return self.name + ">" + wrapper_str(other)
-    
-    def __le__(self, other):
-        if isinstance(other, datetime):
-            other = other.strftime("%Y-%m-%d %H:%M:%S")
-        return self.name + "<=" + wrapper_str(other)
-
-    def __ge__(self, other):
-        if isinstance(other, datetime):
-            other = other.strftime("%Y-%m-%d %H:%M:%S")
-        return self.name + ">=" + wrapper_str(other)
-
-    def connect_str(self, v):
-        return wrapper_str(v.strftime("%Y-%m-%d %H:%M:%S"))
+    def to_db(self, v):
+        if isinstance(v, datetime):
+            return v.strftime("%Y-%m-%d %H:%M:%S")
+        return v
 
 
 class DateFiled(BaseField):
@@ -164,35 +212,34 @@ class DateFiled(BaseField):
             default=default,
             primary_key=primary_key)
 
-    def __eq__(self, other):
-        if isinstance(other, date):
-            other = other.strftime("%Y-%m-%d")
-        return self.name + "=" + wrapper_str(other)
+    def to_db(self, v):
+        if isinstance(v, date):
+            return v.strftime("%Y-%m-%d")
+        return v
 
-    def __ne__(self, other):
-        if isinstance(other, date):
-            other = other.strftime("%Y-%m-%d")
-        return self.name + "!=" + wrapper_str(other)
-
-    def __lt__(self, other):
-        if isinstance(other, date):
-            other = other.strftime("%Y-%m-%d")
-        return self.name + "<" + wrapper_str(other)
-
-    def __gt__(self, other):
-        if isinstance(other, date):
-            other = other.strftime("%Y-%m-%d")
-        return self.name + ">" + wrapper_str(other)
-
-    def __le__(self, other):
-        if isinstance(other, date):
-            other = other.strftime("%Y-%m-%d")
-        return self.name + "<=" + wrapper_str(other)
 
-    def __ge__(self, other):
-        if isinstance(other, date):
-            other = other.strftime("%Y-%m-%d")
-        return self.name + ">=" + wrapper_str(other)
-
-    def connect_str(self, v):
-        return wrapper_str(v.strftime("%Y-%m-%d"))
\ No newline at end of file
+class ForeignKey(BaseField):
+    """
+    引用另一个model主键的字段，model上会多一个访问关联对象的属性
+    :param to: 关联的model类，或者还没有定义的model的类名，其他模块的model写成"模块.类名"
+    :param related_name: 关联对象的属性名，默认是属性名去掉_id，比如author_id是author
+    >>> class Article(Model):
+    >>>     author_id = ForeignKey(User, name="author_id")
+    >>> Article.query.prefetch("author").all()[0].author.name
+    """
+    def __init__(self, to, name="", doc="", default=None, primary_key=False, related_name=None):
+        super(ForeignKey, self).__init__(
+            name=name,
+            doc=doc,
+            default=default,
+            primary_key=primary_key)
+        self.to = to
+        self.related_name = related_name
+        # 定义model时设置的Relation
+        self.relation = None
+
+    def to_db(self, v):
+        """按引用的主键字段转换，引用的model还没有定义时不转换"""
+        if self.relation is None:
+            return v
+        return self.relation.to_db(v)
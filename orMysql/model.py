@@ -2,54 +2,904 @@
 
 from __future__ import unicode_literals
 
+import csv
+import heapq
+import json
 import warnings
+from array import array
+from calendar import timegm
+from collections import OrderedDict
+from datetime import date, datetime
+from gzip import GzipFile
+from io import BytesIO
+from itertools import chain, islice
 
-from orMysql.db import db
-from orMysql.fields import StringFiled, BaseField
+from pymysql.cursors import Cursor, SSCursor
+
+from orMysql.db import db, run_parallel
+from orMysql.fields import BaseField, Deferred, Expression, UNSET, \
+    IntFiled, FloatFiled, DecimalField, DateTimeFiled, DateFiled, ForeignKey
 from utils import wrapper_str, Property
 
 
+def _select(cls, sql, params, pool=None):
+    """
+    查询，model设置了__cache_ttl__并且开启了缓存时使用缓存，
+    事务里面不使用缓存，未提交的数据不能被其他线程读到，也要能读到自己刚写的数据
+    :param pool: 分片的连接池，None表示使用db.read_session
+    """
+    def load():
+        session = db.read_session if pool is None else pool.session
+        return session.select(sql, params, Cursor)
+    cache = db.get_cache()
+    if cache is None or not cls.__cache_ttl__ or db.current_transaction() is not None:
+        return load()
+    key = (sql, tuple(params)) if pool is None else (sql, tuple(params), id(pool))
+    return cache.fetch(cls.__tablename__, key, cls.__cache_ttl__, load)
+
+
+def _select_pks(cls, head, pks, chunk_size=1000):
+    """
+    按主键分批查询，WHERE 主键 IN (...)，联合主键时使用行构造器，
+    分片键是主键的一部分时每个分片只查询属于它的主键，否则并发地查询所有的分片
+    :param head: SELECT 字段 FROM 表
+    :param pks: [主键的tuple]，和__primary_key__的顺序一致
+    :return: 所有的行
+    """
+    pk_fields = [cls.__map__[cls.__db_map__[x]] for x in cls.__primary_key__]
+    attrs = [x.attr for x in pk_fields]
+    position = attrs.index(cls.__shard_key__) if cls.__shard_key__ in attrs else None
+    groups = OrderedDict()
+    for pk in pks:
+        pools = _shard_pools(cls, UNSET if position is None else pk[position])
+        for pool in pools or [None]:
+            groups.setdefault(pool, []).append(pk)
+
+    def select(pool, chunk):
+        expression = _in_expression(pk_fields, chunk)
+        return _select(cls, "%s WHERE %s" % (head, expression.sql), expression.params, pool)
+    funcs = [lambda pool=pool, chunk=values[i:i + chunk_size]: select(pool, chunk)
+             for pool, values in groups.iteritems() for i in range(0, len(values), chunk_size)]
+    if None in groups or len(funcs) <= 1:
+        return [row for func in funcs for row in func()]
+    rows = []
+    for result, error in run_parallel(funcs, len(groups)):
+        if error is not None:
+            raise error[0], error[1], error[2]
+        rows.extend(result)
+    return rows
+
+
+def _shard_pools(cls, value=UNSET):
+    """
+    查询分片model要使用的连接池，不是分片的model返回None
+    :param value: 分片键的值，没有时返回所有的分片
+    """
+    shards = db.get_shards()
+    if shards is None or cls.__shard_key__ is None:
+        return None
+    if value is UNSET:
+        return shards.pools
+    return [shards.pool_for(cls, value)]
+
+
+def _scatter(cls, pools, sql, params):
+    """在每个分片上并发地查询，返回每个分片的结果"""
+    results = run_parallel([lambda pool=pool: _select(cls, sql, params, pool) for pool in pools], len(pools))
+    for _, error in results:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return [x for x, _ in results]
+
+
+def _iter_select(pool, sql, params, batch_size):
+    """
+    用pool的非缓冲游标逐行返回tuple，第一次读取时才获取连接，
+    没有开始读取就被关闭的生成器不会占用连接
+    """
+    rows = pool.session.iter_select(sql, params, batch_size, SSCursor)
+    try:
+        for row in rows:
+            yield row
+    finally:
+        rows.close()
+
+
+def _pk_tuple(id_):
+    return tuple(id_) if isinstance(id_, (tuple, list)) else (id_, )
+
+
+def _fold_key(key):
+    """
+    按mysql默认的不区分大小写、忽略末尾空格的排序规则比较字符串主键，
+    数据库返回的值和传入的值大小写不同时仍然能对应上
+    >>> _fold_key((1, "Ling "))
+    (1, u'ling')
+    """
+    result = []
+    for v in key:
+        if isinstance(v, str):
+            v = v.decode("utf-8", "replace")
+        if isinstance(v, unicode):
+            v = v.rstrip(u" ").lower()
+        result.append(v)
+    return tuple(result)
+
+
+def _raw_sql(s):
+    """
+    原生的sql片段，查询总是带参数执行，转义其中的%
+    >>> print _raw_sql("DATE_FORMAT(create_time,'%Y-%m') ")
+    DATE_FORMAT(create_time,'%%Y-%%m')
+    """
+    if not isinstance(s, basestring):
+        s = str(s)
+    return s.strip().replace("%", "%%")
+
+
+class _Desc(object):
+    """倒序排序的值"""
+    __slots__ = ("value", )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _merge(iterables, key=None):
+    """
+    k路归并，每个iterable已经按key排好序，边读边合并，key是None时依次连接
+    >>> list(_merge([[1, 4], [2, 3]], lambda x: x))
+    [1, 2, 3, 4]
+    """
+    if key is None:
+        for row in chain(*iterables):
+            yield row
+        return
+    heap = []
+    for i, iterable in enumerate(iterables):
+        iterable = iter(iterable)
+        for row in iterable:
+            heap.append((key(row), i, row, iterable))
+            break
+    heapq.heapify(heap)
+    while heap:
+        _, i, row, iterable = heap[0]
+        yield row
+        for row in iterable:
+            heapq.heapreplace(heap, (key(row), i, row, iterable))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def _not_none(values):
+    return [x for x in values if x is not None]
+
+
+NAN = float("nan")
+
+
+def _epoch(v):
+    """datetime和date转换成epoch秒数，按UTC计算"""
+    if isinstance(v, datetime):
+        return timegm(v.utctimetuple()) + v.microsecond / 1e6
+    if isinstance(v, date):
+        return float(timegm(v.timetuple()))
+    return NAN
+
+
+class _Column(object):
+    """
+    to_columns的一列，按字段的类型选择存放的数组
+    :param field: 字段
+    """
+    def __init__(self, field):
+        if isinstance(field, IntFiled):
+            self.values = array(b"l")
+        elif isinstance(field, (FloatFiled, DecimalField, DateTimeFiled, DateFiled)):
+            self.values = array(b"d")
+        else:
+            self.values = []
+        self.epoch = isinstance(field, (DateTimeFiled, DateFiled))
+
+    def extend(self, values):
+        column = self.values
+        if self.epoch:
+            column.extend([_epoch(x) for x in values])
+        elif not isinstance(column, array):
+            column.extend(values)
+        elif column.typecode == "d":
+            column.extend([NAN if x is None else float(x) for x in values])
+        elif None in values:
+            # 整数列有NULL时换成浮点数
+            self.values = array(b"d", column)
+            self.extend(values)
+        else:
+            column.extend(values)
+
+
+def _text(field, v):
+    """export的值转换成utf-8编码的字符串，field是None时不转换"""
+    if v is None:
+        return b""
+    if field is not None:
+        v = field.to_db(v)
+    if isinstance(v, unicode):
+        return v.encode("utf-8")
+    if isinstance(v, float):
+        return repr(v)
+    return bytes(v)
+
+
+def _csv_render(fields):
+    """一批tuple转换成csv"""
+    def render(rows):
+        buf = BytesIO()
+        writer = csv.writer(buf, lineterminator=b"\n")
+        writer.writerows([[_text(f, v) for f, v in zip(fields, row)] for row in rows])
+        return buf.getvalue()
+    return render
+
+
+def _json_default(v):
+    # Decimal等json不支持的类型转成字符串，不丢失精度
+    return unicode(v)
+
+
+def _jsonl_render(fields):
+    """一批tuple转换成json lines"""
+    attrs = [x.attr for x in fields]
+    dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=_json_default).encode
+
+    def render(rows):
+        lines = [dumps(OrderedDict(zip(attrs, [v if v is None else f.to_db(v) for f, v in zip(fields, row)])))
+                 for row in rows]
+        lines.append("")
+        return "\n".join(lines).encode("utf-8")
+    return render
+
+
+def _keyset_expression(fields, values, op):
+    """
+    (a, b) > (1, 2)展开成a > 1 OR (a = 1 AND b > 2)，方便使用索引
+    """
+    if len(fields) != len(values):
+        raise Exception("the key should have %s values" % len(fields))
+    ors = []
+    params = []
+    for i in range(len(fields)):
+        ands = [fields[j] == values[j] for j in range(i)] + [fields[i]._compare(op, values[i])]
+        ors.append(" AND ".join([x.sql for x in ands]))
+        for x in ands:
+            params.extend(x.params)
+    if len(ors) == 1:
+        return Expression(ors[0], params)
+    return Expression("(%s)" % " OR ".join(["(%s)" % x for x in ors]), params)
+
+
+def _in_expression(fields, values):
+    """
+    fields IN values，多个字段时使用行构造器(a,b) IN ((1,2),(3,4))
+    :param values: [tuple]，每个tuple和fields一一对应
+    """
+    if len(fields) == 1:
+        return fields[0].in_([x[0] for x in values])
+    if not values:
+        return Expression("1=0")
+    row = "(%s)" % ",".join(["%s"] * len(fields))
+    sql = "(%s) IN (%s)" % (",".join([x.name for x in fields]), ",".join([row] * len(values)))
+    return Expression(sql, [f.to_db(v) for x in values for f, v in zip(fields, x)])
+
+
+class DeferredLoader(Deferred):
+    """
+    only/defer查询时没有加载的字段，某个对象第一次访问时，
+    用一条WHERE 主键 IN (...)的查询为同一批对象一起加载
+    :param cls: model类
+    :param attrs: 没有加载的字段
+    """
+    # 一批对象的个数
+    BATCH_SIZE = 1000
+
+    def __init__(self, cls, attrs):
+        self.cls = cls
+        self.attrs = attrs
+        self.objects = []
+
+    def load(self):
+        objects, self.objects = self.objects, []
+        if not objects:
+            return
+        cls = self.cls
+        pk_fields = [cls.__map__[cls.__db_map__[x]] for x in cls.__primary_key__]
+        indexes = [cls.__index__[k] for k in self.attrs]
+        # 多个分片指向同一个库时同一个主键可能有多个对象
+        objects_by_pk = {}
+        for obj in objects:
+            objects_by_pk.setdefault(tuple([obj.__values__[x.index] for x in pk_fields]), []).append(obj)
+        head = "SELECT %s FROM %s" % (
+            ",".join([wrapper_str(x.name, "`") for x in pk_fields] +
+                     [wrapper_str(cls.__map__[k].name, "`") for k in self.attrs]),
+            cls.__tablename__)
+        # 分片的model到记录所在的分片查询
+        for row in _select_pks(cls, head, objects_by_pk.keys(), self.BATCH_SIZE):
+            for obj in objects_by_pk.get(tuple(row[:len(pk_fields)]), ()):
+                for index, v in zip(indexes, row[len(pk_fields):]):
+                    if obj.__values__[index] is self:
+                        obj.__values__[index] = v
+        # 已经被删除的记录
+        for obj in objects:
+            for index in indexes:
+                if obj.__values__[index] is self:
+                    obj.__values__[index] = None
+
+
+class Relation(object):
+    """
+    ForeignKey关联的对象，通过对象访问时返回关联的对象，关联的记录不存在时是None。
+    没有prefetch时第一次访问按外键查询一次，结果缓存在对象上，外键变化后重新查询
+    :param name: 关联对象的属性名
+    :param field: 外键字段
+    :param module: 定义外键的模块，ForeignKey只写了类名时在这个模块里查找
+    """
+    # 每条IN查询的外键个数
+    CHUNK_SIZE = 1000
+
+    def __init__(self, name, field, module):
+        self.name = name
+        self.field = field
+        self.module = module
+
+    @property
+    def model(self):
+        to = self.field.to
+        if isinstance(to, basestring):
+            key = to if "." in to else "%s.%s" % (self.module, to)
+            if key not in MetaModel.models:
+                raise Exception("the model %s of %s is not defined" % (key, self.name))
+            to = self.field.to = MetaModel.models[key]
+        return to
+
+    def to_db(self, v):
+        """外键的值用引用的主键字段转换"""
+        try:
+            model = self.model
+        except Exception:
+            return v
+        if len(model.__primary_key__) != 1:
+            return v
+        return model.__map__[model.__db_map__[model.__primary_key__[0]]].to_db(v)
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = self._value(obj)
+        related = _get_related(obj)
+        if self.name not in related or related[self.name][0] != value:
+            self.load([obj])
+        return related[self.name][1]
+
+    def _value(self, obj):
+        try:
+            return self.field.__get__(obj, type(obj))
+        except AttributeError:
+            return None
+
+    def load(self, objects):
+        """
+        用get_many分批查询一批对象关联的对象
+        """
+        model = self.model
+        if len(model.__primary_key__) != 1:
+            raise Exception("ForeignKey should reference a model with a single primary key")
+        pairs = [(obj, self._value(obj)) for obj in objects]
+        objects_by_pk, _ = model.get_many([v for _, v in pairs if v is not None], self.CHUNK_SIZE)
+        for obj, v in pairs:
+            _get_related(obj)[self.name] = (v, objects_by_pk.get(v))
+
+
 class Queryer(object):
     def __init__(self, cls):
         self.cls = cls
-        self.sql = "SELECT %s FROM %s " % (",".join(self.fields), self.cls.__tablename__)
+        self.wheres = []
+        self.params = []
+        self.order_bys = []
+        self.group_bys = []
+        # only/defer之后要查询的字段，None表示所有字段
+        self.only_attrs = None
+        self._limit = None
+        self._offset = None
+        # filter里面分片键等于的值，UNSET表示查询所有的分片
+        self.shard_value = UNSET
+        # 查询之后要一起加载的关联对象
+        self.prefetches = []
 
     @property
     def fields(self):
-        return list(map(lambda x: wrapper_str(x.name, "`"), self.cls.__map__.itervalues()))
+        return list(map(lambda x: wrapper_str(self.cls.__map__[x].name, "`"), self.cls.__columns__))
+
+    @property
+    def sql(self):
+        return self._build()
+
+    def _build(self, columns=None):
+        """
+        :param columns: SELECT的内容，None表示所有字段
+        """
+        if columns is None and self.only_attrs is None:
+            sql = self.cls.select_head()
+        else:
+            if columns is None:
+                columns = ",".join([wrapper_str(self.cls.__map__[k].name, "`") for k in self.only_attrs])
+            sql = "SELECT %s FROM %s" % (columns, self.cls.__tablename__)
+        if self.wheres:
+            sql += " WHERE " + " AND ".join(self.wheres)
+        if self.group_bys:
+            sql += " GROUP BY " + ",".join(self.group_bys)
+        if self.order_bys:
+            sql += " ORDER BY " + ",".join(self.order_bys)
+        if self._limit is not None:
+            sql += " LIMIT %d" % self._limit
+        if self._offset is not None:
+            sql += " OFFSET %d" % self._offset
+        return sql
 
     def filter(self, *args, **kwargs):
-        if len(args) > 0:
-            self.sql += " WHERE " + " AND ".join(args)
+        for arg in args:
+            if isinstance(arg, Expression):
+                self.wheres.append(arg.sql)
+                self.params.extend(arg.params)
+                key = self.cls.__shard_key__
+                if key is not None and arg.sql == self.cls.__map__[key].name + "=%s":
+                    self.shard_value = arg.params[0]
+            else:
+                self.wheres.append(_raw_sql(arg))
         return self
 
+    def _hydrate(self, rows):
+        identity_map = db.current_identity_map()
+        if self.only_attrs is not None:
+            rows = self._hydrate_partial(rows)
+        else:
+            rows = (self.cls.from_tuple(x) for x in rows)
+        if identity_map is None:
+            return rows
+        return (identity_map.merge(x) for x in rows)
+
+    def _hydrate_partial(self, rows):
+        indexes = [self.cls.__index__[k] for k in self.only_attrs]
+        deferred = tuple([k for k in self.cls.__columns__ if k not in self.only_attrs])
+        loader = DeferredLoader(self.cls, deferred)
+        for row in rows:
+            if len(loader.objects) >= DeferredLoader.BATCH_SIZE:
+                loader = DeferredLoader(self.cls, deferred)
+            obj = self.cls.from_partial(row, indexes, loader)
+            loader.objects.append(obj)
+            yield obj
+
+    def _attrs(self, fields):
+        return [x if isinstance(x, basestring) else x.attr for x in fields]
+
+    def only(self, *fields):
+        """
+        只查询这些字段(主键总会查询)，其他字段第一次访问时再分批加载
+        >>> User.query.only(User.name).all()
+        """
+        attrs = set(self._attrs(fields))
+        attrs.update([self.cls.__db_map__[x] for x in self.cls.__primary_key__])
+        self.only_attrs = tuple([k for k in self.cls.__columns__ if k in attrs])
+        return self
+
+    def defer(self, *fields):
+        """
+        不查询这些字段，第一次访问时再分批加载
+        >>> User.query.defer(User.content).all()
+        """
+        attrs = set(self._attrs(fields))
+        attrs.difference_update([self.cls.__db_map__[x] for x in self.cls.__primary_key__])
+        self.only_attrs = tuple([k for k in (self.only_attrs or self.cls.__columns__) if k not in attrs])
+        return self
+
+    def values_list(self, *fields, **kwargs):
+        """
+        只返回这些字段的值组成的tuple，不创建对象
+        :param fields: 字段或者属性名，默认是所有字段
+        :param flat: 只有一个字段时返回值的list
+        >>> User.query.values_list(User.id_, "name")
+        [(1, "linghaihui"), (2, "haihui")]
+        """
+        fields = self._fields(fields)
+        columns = ",".join([wrapper_str(x.name, "`") for x in fields])
+        rows = self._rows(columns, [x.name for x in fields])
+        if kwargs.get("flat") and len(fields) == 1:
+            return [x[0] for x in rows]
+        return [tuple(x) for x in rows]
+
+    def values(self, *fields):
+        """
+        返回字段名到值的dict，不创建对象
+        >>> User.query.values(User.id_, User.name)
+        [{"id_": 1, "name": "linghaihui"}]
+        """
+        fields = self._fields(fields)
+        attrs = [f.attr for f in fields]
+        return [dict(zip(attrs, x)) for x in self.values_list(*fields)]
+
     def all(self):
-        result = db.session.select(self.sql)
-        object_result = []
-        for x in result:
-            obj = {}
-            for k, v in x.iteritems():
-                obj[self.cls.__db_map__[k]] = v
-            object_result.append(self.cls(**obj))
-        return object_result
+        objects = list(self._hydrate(self._rows()))
+        self._prefetch(objects)
+        return objects
+
+    def prefetch(self, *names):
+        """
+        查询之后加载关联的对象，每个关联用WHERE 主键 IN (...)分批查询，
+        避免逐个访问关联对象时每个对象一次查询
+        :param names: ForeignKey对应的关联对象的属性名
+        >>> for article in Article.query.prefetch("author").all(): print article.author.name
+        """
+        for name in names:
+            if name not in self.cls.__relations__:
+                raise Exception("%s has no relation named %s" % (self.cls.__name__, name))
+            if name not in self.prefetches:
+                self.prefetches.append(name)
+        return self
+
+    def _prefetch(self, objects):
+        if objects:
+            for name in self.prefetches:
+                self.cls.__relations__[name].load(objects)
+
+    def _pools(self):
+        """要查询的分片，不是分片的model返回None"""
+        return _shard_pools(self.cls, self.shard_value)
+
+    def _names(self):
+        """查询的所有字段的数据库字段名"""
+        return [self.cls.__map__[k].name for k in (self.only_attrs or self.cls.__columns__)]
+
+    def _rows(self, columns=None, names=None):
+        """
+        查询结果的tuple，分片的model没有指定分片键时并发地查询所有的分片，
+        每个分片LIMIT limit+offset，再按order_by归并之后跳过offset
+        :param columns: SELECT的内容，None表示所有字段
+        :param names: columns对应的数据库字段名，用来归并
+        """
+        pools = self._pools()
+        if pools is None:
+            return _select(self.cls, self._build(columns), self.params)
+        if len(pools) == 1:
+            return _select(self.cls, self._build(columns), self.params, pools[0])
+        query = self._shard_query()
+        results = _scatter(self.cls, pools, query._build(columns), query.params)
+        return list(self._slice(_merge(results, self._merge_key(names or self._names()))))
+
+    def _shard_query(self):
+        """每个分片上执行的查询"""
+        if self.group_bys:
+            raise Exception("group_by across shards is not supported, filter by the shard key")
+        query = self._clone()
+        if self._limit is not None:
+            query._limit = self._limit + (self._offset or 0)
+        query._offset = None
+        return query
+
+    def _slice(self, rows):
+        start = self._offset or 0
+        return islice(rows, start, None if self._limit is None else start + self._limit)
+
+    def _merge_key(self, names):
+        """
+        按order_by归并的key，只支持按查询了的字段排序，
+        字符串按python的顺序比较，和数据库的collation可能不一样
+        """
+        if not self.order_bys:
+            return None
+        orders = []
+        for order in self.order_bys:
+            parts = order.replace("`", "").split()
+            if len(parts) > 2 or parts[0] not in names or \
+                    (len(parts) == 2 and parts[1].upper() not in ("ASC", "DESC")):
+                raise Exception("query across shards can only order by the selected fields, not %s" % order)
+            orders.append((names.index(parts[0]), len(parts) == 2 and parts[1].upper() == "DESC"))
+
+        def key(row):
+            return tuple([_Desc(row[i]) if desc else row[i] for i, desc in orders])
+        return key
+
+    def iter(self, batch_size=1000):
+        """
+        使用非缓冲游标流式获取结果, 内存占用不随结果集的大小增长,
+        生成器结束或者关闭之后连接才会放回连接池
+        :param batch_size: 每次从socket读取的行数
+        >>> for user in User.query.filter(User.id_ > 1).iter(batch_size=500): print user.name
+        """
+        objects = self._hydrate(self._stream(batch_size))
+        if not self.prefetches:
+            for obj in objects:
+                yield obj
+            return
+        # 每batch_size个对象加载一次关联对象
+        while True:
+            batch = list(islice(objects, batch_size))
+            if not batch:
+                break
+            self._prefetch(batch)
+            for obj in batch:
+                yield obj
+
+    def _stream(self, batch_size, columns=None, names=None):
+        """
+        用非缓冲游标逐行返回tuple，分片的model没有指定分片键时每个分片一个游标，边读边归并
+        :param columns: SELECT的内容，None表示所有字段
+        :param names: columns对应的数据库字段名，用来归并
+        """
+        pools = self._pools()
+        if pools is None:
+            rows = db.read_session.iter_select(self._build(columns), self.params, batch_size, SSCursor)
+            try:
+                for row in rows:
+                    yield row
+            finally:
+                rows.close()
+            return
+        if len(pools) == 1:
+            for row in _iter_select(pools[0], self._build(columns), self.params, batch_size):
+                yield row
+            return
+        query = self._shard_query()
+        sql = query._build(columns)
+        # 没有order_by时依次读取每个分片，提前结束时后面的分片不会获取连接
+        streams = [_iter_select(x, sql, query.params, batch_size) for x in pools]
+        try:
+            for row in self._slice(_merge(streams, self._merge_key(names or self._names()))):
+                yield row
+        finally:
+            for stream in streams:
+                stream.close()
+
+    def to_columns(self, *fields, **kwargs):
+        """
+        按列返回结果，用非缓冲游标分批读取，不创建对象和dict。
+        IntFiled是array("l")，FloatFiled和DecimalField是array("d")，
+        DateTimeFiled和DateFiled是epoch秒数(按UTC)的array("d")，其他字段是list。
+        数值和时间的NULL是nan，整数列有NULL时变成array("d")
+        :param fields: 要查询的字段，默认是所有字段
+        :param batch_size: 每次从socket读取的行数
+        :param numpy: 是否转换成numpy的数组，需要安装numpy
+        :return: 属性名到数组的dict
+        >>> columns = User.query.filter(User.age > 18).to_columns(User.age, User.create_time)
+        >>> sum(columns["age"]) / len(columns["age"])
+        """
+        batch_size = kwargs.get("batch_size", 1000)
+        fields = self._fields(fields)
+        columns = [_Column(x) for x in fields]
+        names = [x.name for x in fields]
+        rows = self._stream(batch_size, ",".join([wrapper_str(x, "`") for x in names]), names)
+        try:
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                for column, values in zip(columns, zip(*batch)):
+                    column.extend(values)
+        finally:
+            rows.close()
+        result = dict([(x.attr, column.values) for x, column in zip(fields, columns)])
+        if kwargs.get("numpy"):
+            try:
+                import numpy
+            except ImportError:
+                raise Exception("to_columns(numpy=True) needs numpy")
+            for k, v in result.iteritems():
+                if isinstance(v, array):
+                    result[k] = numpy.frombuffer(v, dtype="%s%d" % ("i" if v.typecode == "l" else "f", v.itemsize))
+                else:
+                    result[k] = numpy.array(v, dtype=object)
+        return result
+
+    def export(self, fileobj, format="csv", chunk_size=1000, gzip=False, fields=None, header=True):
+        """
+        把结果流式写到文件，用非缓冲游标每次读取chunk_size行，序列化后一次写入，内存占用和结果的行数无关。
+        时间和日期按字段的to_db格式化，字符串按utf-8编码，csv的NULL是空字符串，jsonl的NULL是null
+        :param fileobj: 以二进制方式打开的文件对象
+        :param format: csv或者jsonl(每行一个json对象，key是属性名)
+        :param chunk_size: 每次读取和写入的行数
+        :param gzip: 是否用gzip压缩，不会关闭fileobj
+        :param fields: 要导出的字段，默认是所有字段
+        :param header: csv是否写表头(属性名)
+        :return: 导出的行数
+        >>> with open("user.csv.gz", "wb") as f:
+        >>>     User.query.filter(User.age > 18).export(f, gzip=True)
+        """
+        if format not in ("csv", "jsonl"):
+            raise Exception("format should be csv or jsonl")
+        fields = self._fields(fields)
+        names = [x.name for x in fields]
+        attrs = [x.attr for x in fields]
+        render = _csv_render(fields) if format == "csv" else _jsonl_render(fields)
+        out = GzipFile(fileobj=fileobj, mode="wb") if gzip else fileobj
+        rows = self._stream(chunk_size, ",".join([wrapper_str(x, "`") for x in names]), names)
+        count = 0
+        try:
+            if format == "csv" and header:
+                out.write(_csv_render([None] * len(attrs))([attrs]))
+            while True:
+                batch = list(islice(rows, chunk_size))
+                if not batch:
+                    break
+                out.write(render(batch))
+                count += len(batch)
+        finally:
+            rows.close()
+            if gzip:
+                # 写入gzip的结尾，fileobj由调用者关闭
+                out.close()
+        return count
+
+    def _fields(self, fields):
+        """字段或者属性名转换成字段，默认是所有字段"""
+        if fields:
+            return [self.cls.__map__[x] if isinstance(x, basestring) else x for x in fields]
+        return [self.cls.__map__[k] for k in (self.only_attrs or self.cls.__columns__)]
+
+    def _clone(self):
+        query = Queryer(self.cls)
+        query.wheres = list(self.wheres)
+        query.params = list(self.params)
+        query.order_bys = list(self.order_bys)
+        query.group_bys = list(self.group_bys)
+        query.only_attrs = self.only_attrs
+        query._limit = self._limit
+        query._offset = self._offset
+        query.shard_value = self.shard_value
+        query.prefetches = list(self.prefetches)
+        return query
+
+    def _key_fields(self, key_field):
+        """分页的字段，默认是主键"""
+        if key_field is None:
+            return [self.cls.__map__[self.cls.__db_map__[x]] for x in self.cls.__primary_key__]
+        if not isinstance(key_field, (tuple, list)):
+            key_field = [key_field]
+        return [self.cls.__map__[x] if isinstance(x, basestring) else x for x in key_field]
+
+    def paginate_by(self, key_field=None, after=None, page_size=100, desc=False):
+        """
+        按key分页，用WHERE key > 上一页最后的key ORDER BY key LIMIT n代替OFFSET，
+        翻到多深每一页的代价都一样
+        :param key_field: 分页的字段或者多个字段组成的tuple，需要是唯一的，默认是主键
+        :param after: 上一页返回的key，None表示第一页
+        :param page_size: 每页的数量
+        :param desc: 是否倒序
+        :return: (这一页的对象, 下一页的after)，没有下一页时after是None
+        >>> users, after = User.query.paginate_by(User.id_, page_size=20)
+        >>> users, after = User.query.paginate_by(User.id_, after=after, page_size=20)
+        """
+        if self.order_bys or self._offset is not None:
+            raise Exception("paginate_by orders by the key, remove order_by and offset")
+        fields = self._key_fields(key_field)
+        query = self._clone()
+        if after is not None:
+            values = after if isinstance(after, (tuple, list)) else (after, )
+            query.filter(_keyset_expression(fields, values, "<" if desc else ">"))
+        query.order_by(*[x.desc() if desc else x.asc() for x in fields])
+        query._limit = page_size
+        objects = query.all()
+        if len(objects) < page_size:
+            return objects, None
+        key = tuple([objects[-1][x.attr] for x in fields])
+        return objects, key[0] if len(key) == 1 else key
+
+    def chunked(self, page_size=1000):
+        """
+        按主键分页遍历所有的结果，每次yield一页
+        >>> for users in User.query.filter(User.id_ > 100).chunked(500): print len(users)
+        """
+        after = None
+        while True:
+            objects, after = self.paginate_by(None, after, page_size)
+            if objects:
+                yield objects
+            if after is None:
+                return
+
+    def _scalar(self, column, merge=None):
+        """
+        :param merge: 合并每个分片结果的函数，None表示不能合并
+        """
+        if self.group_bys and column != "COUNT(*)":
+            raise Exception("%s with group_by is ambiguous, use aggregate() to get the value of each group" % column)
+        pools = self._pools()
+        if pools is not None and len(pools) > 1:
+            if merge is None or self._limit is not None or self._offset is not None or self.group_bys:
+                raise Exception("%s across shards is not supported, filter by the shard key" % column)
+            query = self._shard_query()
+            return merge([x[0][0] for x in _scatter(self.cls, pools, query._build(column), query.params)])
+        if self.group_bys:
+            # 有GROUP BY时返回分组的个数
+            sql = "SELECT %s FROM (%s) AS t" % (column, self._build("1"))
+        elif self._limit is not None or self._offset is not None:
+            # 有LIMIT时对子查询聚合
+            sql = "SELECT %s FROM (%s) AS t" % (column, self._build("*"))
+        else:
+            sql = self._build(column)
+        return _select(self.cls, sql, self.params, pools and pools[0])[0][0]
+
+    def count(self):
+        """
+        在数据库计算满足条件的记录数，不会返回记录，有group_by时是分组的个数
+        >>> User.query.filter(User.age > 18).count()
+        """
+        return self._scalar("COUNT(*)", sum)
+
+    def exists(self):
+        """是否存在满足条件的记录，SELECT 1 ... LIMIT 1"""
+        query = self._clone()
+        query._limit = 1
+        query._offset = None
+        query.order_bys = []
+        return len(query._rows("1", [])) > 0
+
+    def sum(self, field):
+        return self._scalar(field.sum(), lambda x: sum(_not_none(x)) if _not_none(x) else None)
+
+    def min(self, field):
+        return self._scalar(field.min(), lambda x: min(_not_none(x)) if _not_none(x) else None)
+
+    def max(self, field):
+        return self._scalar(field.max(), lambda x: max(_not_none(x)) if _not_none(x) else None)
+
+    def avg(self, field):
+        pools = self._pools()
+        if pools is not None and len(pools) > 1:
+            # 分片的平均值不能直接合并，用总和除以总数
+            count = self._scalar(field.count(), sum)
+            return self.sum(field) / count if count else None
+        return self._scalar(field.avg())
+
+    def group_by(self, *attr):
+        self.group_bys.extend(map(_raw_sql, attr))
+        return self
+
+    def aggregate(self, *exprs):
+        """
+        在数据库里聚合，返回tuple而不是对象，每个tuple是group_by的字段加上exprs的值,
+        没有group_by时只返回一个tuple
+        >>> User.query.group_by(User.age).aggregate("COUNT(*)", User.score.max())
+        [(18, 20, 99), (19, 10, 98)]
+        """
+        columns = list(self.group_bys) + list(map(_raw_sql, exprs))
+        pools = self._pools()
+        if pools is not None and len(pools) > 1:
+            raise Exception("aggregate across shards is not supported, filter by the shard key")
+        rows = _select(self.cls, self._build(",".join(columns)), self.params, pools and pools[0])
+        if not self.group_bys:
+            return tuple(rows[0])
+        return [tuple(x) for x in rows]
 
     def first(self):
-        self.sql += " LIMIT 1"
+        self._limit = 1
         objects = self.all()
         if len(objects) <= 0:
             raise Exception("record not exist")
         return objects[0]
 
     def limit(self, limit):
-        self.sql += " LIMIT %s" % limit
+        self._limit = int(limit)
         return self
 
     def offset(self, offset):
-        self.sql += " OFFSET %s" % offset
+        self._offset = int(offset)
         return self
 
     def order_by(self, *attr):
-        self.sql += " ORDER BY %s" % (",".join(map(lambda x: str(x), attr)))
+        self.order_bys.extend(map(_raw_sql, attr))
         return self
 
     def __repr__(self):
@@ -57,6 +907,9 @@ class Queryer(object):
 
 
 class MetaModel(type):
+    # 模块.类名 -> model，ForeignKey用类名引用model时查找
+    models = {}
+
     def __new__(cls, name, bases, attrs):
         if "__tablename__" not in attrs or not attrs["__tablename__"]:
             attrs["__tablename__"] = name.lower()
@@ -73,37 +926,170 @@ class MetaModel(type):
                     __primary_key__.append(v.name)
         if name != 'Model' and not __primary_key__:
             raise Exception("A table should have at least a primary key")
+        if attrs.get("__shard_key__") is not None and attrs["__shard_key__"] not in __map__:
+            raise Exception("the shard key should be a field of the model")
+        # 关联对象的属性名 -> Relation
+        __relations__ = {}
+        for k, v in __map__.iteritems():
+            if isinstance(v, ForeignKey):
+                related = v.related_name or (k[:-3] if k.endswith("_id") else k + "_obj")
+                if related in attrs:
+                    raise Exception("the relation %s conflicts with an attribute" % related)
+                v.relation = Relation(related, v, attrs.get("__module__"))
+                __relations__[related] = attrs[related] = v.relation
+        attrs["__relations__"] = __relations__
         attrs["__map__"] = __map__
         attrs["__db_map__"] = __db_map__
         attrs["__primary_key__"] = __primary_key__
-        return type.__new__(cls, name, bases, attrs)
+        # 字段的值按__columns__的顺序存放，查询时也按这个顺序取字段
+        __columns__ = tuple(sorted(__map__))
+        for index, k in enumerate(__columns__):
+            __map__[k].attr = k
+            __map__[k].index = index
+        attrs["__columns__"] = __columns__
+        attrs["__index__"] = dict([(k, i) for i, k in enumerate(__columns__)])
+        attrs.setdefault("__slots__", ())
+        # 编译好的sql模板，按照字段组合缓存
+        attrs["__statements__"] = {}
+        model = type.__new__(cls, name, bases, attrs)
+        cls.models["%s.%s" % (model.__module__, name)] = model
+        return model
+
+    def _statement(cls, key, build):
+        sql = cls.__statements__.get(key)
+        if sql is None:
+            sql = cls.__statements__[key] = build()
+        return sql
+
+    def _pk_where(cls):
+        return " AND ".join(["`%s`=%%s" % x for x in cls.__primary_key__])
+
+    def select_head(cls):
+        """SELECT 所有字段 FROM 表"""
+        return cls._statement(("select", ), lambda: "SELECT %s FROM %s" % (
+            ",".join([wrapper_str(cls.__map__[k].name, "`") for k in cls.__columns__]),
+            cls.__tablename__))
+
+    def get_sql(cls):
+        """根据主键查询的sql模板，参数顺序和__primary_key__一致"""
+        return cls._statement(("get", ), lambda: "%s WHERE %s" % (cls.select_head(), cls._pk_where()))
+
+    def insert_head(cls, keys):
+        """INSERT INTO 表 (字段) VALUES """
+        return cls._statement(("insert_head", keys), lambda: "INSERT INTO %s (%s) VALUES " % (
+            cls.__tablename__,
+            ",".join([wrapper_str(cls.__map__[k].name, "`") for k in keys])))
+
+    def insert_sql(cls, keys):
+        """单行INSERT的sql模板，参数顺序和keys一致"""
+        return cls._statement(("insert", keys), lambda: "%s(%s)" % (
+            cls.insert_head(keys), ",".join(["%s"] * len(keys))))
+
+    def upsert_tail(cls, fields):
+        """ON DUPLICATE KEY UPDATE部分，没有要更新的字段时什么都不做"""
+        def build():
+            if not fields:
+                pk = cls.__primary_key__[0]
+                return " ON DUPLICATE KEY UPDATE `%s`=`%s`" % (pk, pk)
+            return " ON DUPLICATE KEY UPDATE " + ",".join(
+                ["`%s`=VALUES(`%s`)" % (cls.__map__[k].name, cls.__map__[k].name) for k in fields])
+        return cls._statement(("upsert", fields), build)
+
+    def load_sql(cls, keys, duplicates=None, charset="utf8mb4"):
+        """LOAD DATA LOCAL INFILE的sql，数据按keys的顺序用tab分隔"""
+        return cls._statement(("load", keys, duplicates, charset), lambda: (
+            "LOAD DATA LOCAL INFILE 'orMysql' %sINTO TABLE %s CHARACTER SET %s "
+            "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' (%s)" % (
+                duplicates.upper() + " " if duplicates else "", cls.__tablename__, charset,
+                ",".join([wrapper_str(cls.__map__[k].name, "`") for k in keys]))))
+
+    def update_sql(cls, keys):
+        """根据主键UPDATE的sql模板，参数是keys对应的值加上主键的值"""
+        return cls._statement(("update", keys), lambda: "UPDATE %s SET %s WHERE %s" % (
+            cls.__tablename__,
+            ",".join(["`%s`=%%s" % cls.__map__[k].name for k in keys]),
+            cls._pk_where()))
 
 
 class Dict_Mixin(object):
     """
-    主要实现一些dict的特性
+    主要实现一些dict的特性，字段的值按__columns__的顺序存放在__values__里面，
+    没有赋值的是UNSET，不是字段的属性放在__extra__里面，加载过的关联对象放在__related__里面
     """
+    __slots__ = ("__values__", "__extra__", "__related__")
+    __columns__ = ()
+    __index__ = {}
 
     def __init__(self, **kwargs):
-        self.__dict__['__table_field__'] = []
+        values = [UNSET] * len(self.__columns__)
+        extra = None
         for k, v in kwargs.iteritems():
-            self.__dict__[k] = v
-            self.__dict__['__table_field__'].append(k)
+            index = self.__index__.get(k)
+            if index is not None:
+                values[index] = v
+            else:
+                if extra is None:
+                    extra = {}
+                extra[k] = v
+        _set_values(self, values)
+        _set_extra(self, extra)
 
     def __getitem__(self, key):
-        return self.__dict__[key]
+        index = self.__index__.get(key)
+        if index is not None:
+            v = self.__values__[index]
+            if v is UNSET:
+                raise KeyError(key)
+            if isinstance(v, Deferred):
+                v.load()
+                v = self.__values__[index]
+            return v
+        if self.__extra__ is None:
+            raise KeyError(key)
+        return self.__extra__[key]
 
     def __setitem__(self, key, value):
-        self.__dict__[key] = value
+        index = self.__index__.get(key)
+        if index is not None:
+            self.__values__[index] = value
+        else:
+            if self.__extra__ is None:
+                _set_extra(self, {})
+            self.__extra__[key] = value
 
     def keys(self):
-        for x in self.__dict__["__table_field__"]:
-            yield x
+        for k, v in zip(self.__columns__, self.__values__):
+            if v is not UNSET and not isinstance(v, Deferred):
+                yield k
+        if self.__extra__ is not None:
+            for k in self.__extra__:
+                yield k
+
+
+_set_values = Dict_Mixin.__dict__["__values__"].__set__
+_set_extra = Dict_Mixin.__dict__["__extra__"].__set__
+
+
+def _get_related(obj):
+    """对象上加载过的关联对象，关联对象的属性名 -> (外键的值, 关联对象)，第一次访问时才创建"""
+    try:
+        return _related_slot.__get__(obj, type(obj))
+    except AttributeError:
+        related = {}
+        _related_slot.__set__(obj, related)
+        return related
+
+
+_related_slot = Dict_Mixin.__dict__["__related__"]
 
 
 class Model(Dict_Mixin):
     """Model基类"""
     __metaclass__ = MetaModel
+    # 查询结果缓存的秒数，None表示不缓存，需要先调用db.setup_cache
+    __cache_ttl__ = None
+    # 分片键的属性名，需要先调用db.setup_shards
+    __shard_key__ = None
 
     def __init__(self, **kwargs):
         super(Model, self).__init__(**kwargs)
@@ -118,8 +1104,106 @@ class Model(Dict_Mixin):
     def query(self):
         return Queryer(self)
 
+    @classmethod
+    def from_tuple(cls, row):
+        """把按__columns__顺序查询的一行(tuple)转换成对象，不创建中间的dict"""
+        obj = cls.__new__(cls)
+        _set_values(obj, list(row))
+        _set_extra(obj, None)
+        return obj
+
+    @classmethod
+    def from_partial(cls, row, indexes, deferred):
+        """
+        只查询了部分字段的一行转换成对象
+        :param indexes: row里面每个值在__values__里面的位置
+        :param deferred: 其他字段的值，访问时再加载
+        """
+        values = [deferred] * len(cls.__columns__)
+        for index, v in zip(indexes, row):
+            values[index] = v
+        obj = cls.__new__(cls)
+        _set_values(obj, values)
+        _set_extra(obj, None)
+        return obj
+
     @classmethod
     def get(cls, id_):
-        if len(cls.__primary_key__) != 1:
-            raise Exception('not support multi primary key')
-        return cls.query.filter(cls.__map__[cls.__db_map__[cls.__primary_key__[0]]]==id_).first()
\ No newline at end of file
+        """
+        根据主键获取对象
+        :param id_: 主键的值，联合主键时传入和__primary_key__顺序一致的tuple
+        """
+        ids = id_ if isinstance(id_, (tuple, list)) else (id_, )
+        if len(ids) != len(cls.__primary_key__):
+            raise Exception("primary key should be %s" % ",".join(cls.__primary_key__))
+        identity_map = db.current_identity_map()
+        if identity_map is not None:
+            obj = identity_map.get(cls, ids)
+            if obj is not None:
+                return obj
+        params = [cls.__map__[cls.__db_map__[k]].to_db(v) for k, v in zip(cls.__primary_key__, ids)]
+        values = dict([(cls.__db_map__[k], v) for k, v in zip(cls.__primary_key__, ids)])
+        # 分片键是主键的一部分时直接查询所在的分片，否则查询所有的分片
+        pools = _shard_pools(cls, values.get(cls.__shard_key__, UNSET))
+        if pools is None:
+            result = _select(cls, cls.get_sql(), params)
+        else:
+            result = [x for rows in _scatter(cls, pools, cls.get_sql(), params) for x in rows]
+        if not result:
+            raise Exception("record not exist")
+        obj = cls.from_tuple(result[0])
+        if identity_map is not None:
+            obj = identity_map.merge(obj)
+        return obj
+
+    @classmethod
+    def get_many(cls, ids, chunk_size=1000):
+        """
+        根据多个主键批量获取对象，用WHERE 主键 IN (...)分批查询，联合主键时使用行构造器，
+        重复的主键只查询一次，工作单元里已经有的对象不再查询，
+        分片键是主键的一部分时每个分片只查询属于它的主键，否则查询所有的分片，
+        传入的主键和数据库返回的主键都用字段的to_db转换后再对应，"3"和3是同一个主键
+        :param ids: 主键的值，联合主键时每个是和__primary_key__顺序一致的tuple
+        :param chunk_size: 每条IN查询的主键个数
+        :return: (主键 -> 对象的dict, 不存在的主键list)，key是传入的值，联合主键时key是tuple
+        >>> users, missing = User.get_many([1, 2, 3, 2])
+        """
+        pk_fields = [cls.__map__[cls.__db_map__[x]] for x in cls.__primary_key__]
+        single = len(pk_fields) == 1
+        pks = OrderedDict()
+        for id_ in ids:
+            pk = _pk_tuple(id_)
+            if len(pk) != len(pk_fields):
+                raise Exception("primary key should be %s" % ",".join(cls.__primary_key__))
+            originals = pks.setdefault(tuple([f.to_db(v) for f, v in zip(pk_fields, pk)]), [])
+            if (pk[0] if single else pk) not in originals:
+                originals.append(pk[0] if single else pk)
+        found = {}
+        identity_map = db.current_identity_map()
+        if identity_map is not None:
+            for key, originals in pks.iteritems():
+                obj = identity_map.get(cls, key)
+                if obj is None:
+                    obj = identity_map.get(cls, _pk_tuple(originals[0]))
+                if obj is not None:
+                    found[key] = obj
+        folded = {}
+        for row in _select_pks(cls, cls.select_head(), [x for x in pks if x not in found], chunk_size):
+            obj = cls.from_tuple(row)
+            if identity_map is not None:
+                obj = identity_map.merge(obj)
+            key = tuple([x.to_db(row[x.index]) for x in pk_fields])
+            found[key] = obj
+            folded[_fold_key(key)] = obj
+        result = {}
+        missing = []
+        for key, originals in pks.iteritems():
+            obj = found.get(key)
+            if obj is None:
+                obj = folded.get(_fold_key(key))
+            for original in originals:
+                if obj is None:
+                    missing.append(original)
+                else:
+                    result[original] = obj
+        return result, missing
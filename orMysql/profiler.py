@@ -0,0 +1,169 @@
+# coding=utf-8
+
+from __future__ import unicode_literals
+
+import logging
+import os
+import re
+import sys
+import threading
+
+from utils import Histogram
+
+# 统计sql的时候忽略的值
+STRING_PATTERN = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+NUMBER_PATTERN = re.compile(r"\b0x[0-9a-fA-F]+\b|(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b")
+PLACEHOLDER_PATTERN = re.compile(r"%s")
+LIST_PATTERN = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+ROWS_PATTERN = re.compile(r"\(\?\+\)(?:\s*,\s*\(\?\+\))+")
+NESTED_PATTERN = re.compile(r"\(\(\?\+\)\)")
+WHEN_PATTERN = re.compile(r"(?:when (?:\(\?\+\)|\?) then \? )+")
+SPACE_PATTERN = re.compile(r"\s+")
+
+# 延迟的桶，以秒为单位
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PACKAGE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def fingerprint(sql):
+    """
+    把sql里面的值换成?，IN列表和多行VALUES合并成(?+)，
+    只是值不一样的sql得到同样的结果
+    >>> fingerprint("SELECT * FROM tt.user WHERE id IN (1, 2, 3) AND name='a''b'")
+    'select * from tt.user where id in (?+) and name=?'
+    >>> fingerprint("INSERT INTO t (`a`,`b`) VALUES (1,'x'),(2,'y')")
+    'insert into t (`a`,`b`) values (?+)'
+    >>> fingerprint("SELECT * FROM t WHERE (a,b) IN ((1,2),(3,4))")
+    'select * from t where (a,b) in (?+)'
+    >>> fingerprint("SELECT `id` FROM t2 WHERE id>%s LIMIT 10")
+    'select `id` from t2 where id>? limit ?'
+    """
+    sql = STRING_PATTERN.sub("?", sql)
+    sql = NUMBER_PATTERN.sub("?", sql)
+    sql = PLACEHOLDER_PATTERN.sub("?", sql)
+    sql = SPACE_PATTERN.sub(" ", sql).strip().lower()
+    sql = LIST_PATTERN.sub("(?+)", sql)
+    sql = ROWS_PATTERN.sub("(?+)", sql)
+    sql = NESTED_PATTERN.sub("(?+)", sql)
+    sql = WHEN_PATTERN.sub("when ? then ? ", sql)
+    return str(sql)
+
+
+def origin():
+    """
+    调用者的位置: 发起查询的model，和orMysql之外的第一个调用者(文件:行号 函数)
+    只在慢查询时调用，遍历调用栈的开销不影响正常的查询
+    """
+    model = None
+    caller = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        if os.path.dirname(os.path.abspath(frame.f_code.co_filename)).startswith(PACKAGE_PATH):
+            if model is None:
+                cls = frame.f_locals.get("cls")
+                query = frame.f_locals.get("self")
+                if not hasattr(cls, "__tablename__"):
+                    cls = getattr(query, "cls", None)
+                if hasattr(cls, "__tablename__"):
+                    model = cls.__name__
+        else:
+            caller = "%s:%s %s" % (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+            break
+        frame = frame.f_back
+    return model, caller
+
+
+class QueryProfiler(object):
+    """
+    按fingerprint统计sql的次数、耗时的分布和返回的行数，超过slow_seconds的sql记录到慢查询日志
+    :param slow_seconds: 慢查询的秒数，None表示不记录慢查询
+    :param logger: 慢查询的logger，默认是orMysql.slow
+    :param max_fingerprints: 最多统计的fingerprint个数，之后新的fingerprint都计入"other"
+    """
+    OTHER = "other"
+
+    def __init__(self, slow_seconds=1.0, logger=None, max_fingerprints=1000):
+        self.slow_seconds = slow_seconds
+        self.logger = logger or logging.getLogger("orMysql.slow")
+        self.max_fingerprints = max_fingerprints
+        self.lock = threading.Lock()
+        # fingerprint -> (耗时的直方图, 行数, 第一次出现的sql)
+        self.stats = {}
+        # sql模板 -> fingerprint，只缓存短的sql
+        self.fingerprints = {}
+
+    def fingerprint(self, sql):
+        fp = self.fingerprints.get(sql)
+        if fp is None:
+            fp = fingerprint(sql)
+            if len(sql) <= 1024 and len(self.fingerprints) < self.max_fingerprints * 10:
+                self.fingerprints[sql] = fp
+        return fp
+
+    def observe(self, sql, seconds, rows=None):
+        """
+        记录一条sql
+        :param sql: 执行的sql或者sql模板
+        :param seconds: 耗时
+        :param rows: 返回或者影响的行数
+        """
+        fp = self.fingerprint(sql)
+        with self.lock:
+            stat = self.stats.get(fp)
+            if stat is None:
+                if len(self.stats) >= self.max_fingerprints:
+                    fp = self.OTHER
+                    stat = self.stats.get(fp)
+                if stat is None:
+                    stat = self.stats[fp] = [Histogram(LATENCY_BUCKETS), 0, sql[:1000]]
+            stat[0].observe(seconds)
+            stat[1] += rows or 0
+        if self.slow_seconds is not None and seconds >= self.slow_seconds:
+            model, caller = origin()
+            self.logger.warning("slow query %.3fs rows=%s model=%s caller=%s: %s",
+                                seconds, rows, model, caller, sql[:1000])
+
+    def report(self, order_by="total", limit=None):
+        """
+        每个fingerprint的统计数据，时间以秒为单位，分位数是按直方图估计的
+        :param order_by: 排序的字段，total/count/avg/p99/max/rows
+        :param limit: 返回的条数
+        :return: [{"fingerprint", "sample"(第一次出现的sql), "count", "total", "avg",
+                   "p50", "p95", "p99", "max", "rows", "rows_avg"}]
+        """
+        with self.lock:
+            result = []
+            for fp, (histogram, rows, sample) in self.stats.iteritems():
+                result.append({"fingerprint": fp,
+                               "sample": sample,
+                               "count": histogram.count,
+                               "total": histogram.sum,
+                               "avg": histogram.sum / histogram.count,
+                               "p50": histogram.percentile(0.5),
+                               "p95": histogram.percentile(0.95),
+                               "p99": histogram.percentile(0.99),
+                               "max": histogram.max,
+                               "rows": rows,
+                               "rows_avg": rows / float(histogram.count)})
+        result.sort(key=lambda x: x[order_by], reverse=True)
+        return result[:limit] if limit is not None else result
+
+    def dump(self, fileobj=None, order_by="total", limit=20):
+        """把report按表格写到fileobj，默认是标准输出"""
+        fileobj = fileobj or sys.stdout
+        fileobj.write("%8s %10s %9s %9s %9s %9s %10s  %s\n" % (
+            "count", "total(s)", "avg(ms)", "p50(ms)", "p95(ms)", "p99(ms)", "rows", "fingerprint"))
+        for x in self.report(order_by, limit):
+            fileobj.write("%8d %10.3f %9.2f %9.2f %9.2f %9.2f %10d  %s\n" % (
+                x["count"], x["total"], x["avg"] * 1000, x["p50"] * 1000, x["p95"] * 1000,
+                x["p99"] * 1000, x["rows"], x["fingerprint"]))
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
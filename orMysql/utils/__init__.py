@@ -1,5 +1,7 @@
 # coding=utf-8
 
+from bisect import bisect_left
+
 
 class Property(object):
     """一个简单的non-data描述器"""
@@ -20,6 +22,58 @@ def wrapper_str(s, quotation='"'):
     return quotation + str(s) + quotation
 
 
+class Histogram(object):
+    """
+    一个简单的非线程安全的直方图
+    :param buckets: 各个桶的上界，升序
+    >>> h = Histogram((1, 10))
+    >>> h.observe(0.5); h.observe(5); h.observe(50)
+    >>> h.snapshot()["buckets"]
+    [(1, 1), (10, 1), ('+Inf', 1)]
+    """
+    def __init__(self, buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, v):
+        self.counts[bisect_left(self.buckets, v)] += 1
+        self.count += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    def percentile(self, p):
+        """
+        按桶估计的百分位数，在所在的桶里线性插值
+        :param p: 0到1之间
+        >>> h = Histogram((1, 10))
+        >>> for v in (0.5, 5, 5, 50): h.observe(v)
+        >>> h.percentile(0.5)
+        5.5
+        """
+        if not self.count:
+            return 0
+        rank = p * self.count
+        seen = 0
+        lower = 0
+        for upper, n in zip(self.buckets + (self.max, ), self.counts):
+            if n and seen + n >= rank:
+                upper = min(upper, self.max)
+                return lower + (upper - lower) * (rank - seen) / float(n)
+            seen += n
+            lower = upper
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count,
+                "sum": self.sum,
+                "max": self.max,
+                "buckets": list(zip(self.buckets + ("+Inf", ), self.counts))}
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
\ No newline at end of file
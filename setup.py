@@ -15,7 +15,7 @@ setup(name="orMysql",
     author="linghaihui",
     author_email="haihuiling2014@gmail.com",
     description="A simple orm",
-    packages=find_packages(exclude=["tests"]),
+    packages=find_packages(exclude=["tests", "benchmarks"]),
     install_requires=get_requirements(),
     include_package_data=True,
     zip_safe=False,)
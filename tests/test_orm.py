@@ -2,17 +2,23 @@
 
 from __future__ import unicode_literals
 
+import gzip
+import io
+import json
 import unittest
 from datetime import datetime, timedelta
 
 import sys
+import time
 
 import os
 
+from pymysql.err import OperationalError
+
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from orMysql.db import db
-from orMysql.fields import IntFiled, StringFiled, DateTimeFiled
+from orMysql.db import db, Pool
+from orMysql.fields import IntFiled, StringFiled, DateTimeFiled, ForeignKey
 from orMysql.model import Model
 
 
@@ -23,6 +29,27 @@ class User(Model):
     create_time = DateTimeFiled(name="create_time")
 
 
+class CachedUser(Model):
+    __tablename__ = "tt.user"
+    __cache_ttl__ = 60
+    id_ = IntFiled(name="id", primary_key=True)
+    name = StringFiled(name="name")
+
+
+class ShardedUser(Model):
+    __tablename__ = "tt.user"
+    __shard_key__ = "id_"
+    id_ = IntFiled(name="id", primary_key=True)
+    name = StringFiled(name="name")
+
+
+class Profile(Model):
+    """主键是name，id作为外键引用User，每一行引用自己"""
+    __tablename__ = "tt.user"
+    name = StringFiled(name="name", primary_key=True)
+    owner_id = ForeignKey("User", name="id")
+
+
 class TestOrm(unittest.TestCase):
     def tearDown(self):
         db.session.do_execute("delete from tt.user")
@@ -100,6 +127,410 @@ class TestOrm(unittest.TestCase):
 
         print "unit test done !!!"
 
+    def test_add_all(self):
+        users = [User(name="user%s" % x, create_time=datetime.now()) for x in range(10)]
+        users.append(User(id_=100, name="linghaihui", create_time=datetime.now()))
+        result, ids = db.session.add_all(users, batch_size=3)
+        self.assertEqual(result, 11)
+        self.assertEqual(len(ids), 11)
+        self.assertEqual(ids[-1], None)
+        self.assertEqual(len(User.query.all()), 11)
+        assert User.get(ids[0]).name == "user0"
+
+        result, ids = db.session.add_all([User(name="haihui")] * 5, commit_per_batch=False)
+        self.assertEqual(result, 5)
+        self.assertEqual(len(User.query.all()), 16)
+
+    def test_upsert_update_all(self):
+        db.session.add_all([User(id_=x, name="user%s" % x) for x in range(1, 6)])
+        users = [User(id_=x, name="new%s" % x) for x in range(4, 9)]
+        result = db.session.upsert_all(users, batch_size=2)
+        self.assertEqual(result, 2 * 2 + 3)
+        self.assertEqual(len(User.query.all()), 8)
+        self.assertEqual(User.get(4).name, "new4")
+
+        result = db.session.upsert_all([User(id_=1, name="ignored")], update_fields=[])
+        self.assertEqual(User.get(1).name, "user1")
+
+        users = [User(id_=x, name="updated%s" % x) for x in range(1, 5)] + [User(id_=5)]
+        result = db.session.update_all(users, batch_size=3)
+        self.assertEqual(result, 4)
+        self.assertEqual(User.get(2).name, "updated2")
+        self.assertEqual(User.get(5).name, "user5")
+
+    def test_paginate(self):
+        db.session.add_all([User(id_=x, name="user%s" % x) for x in range(1, 11)])
+        users, after = User.query.paginate_by(User.id_, page_size=4)
+        self.assertEqual([x.id_ for x in users], [1, 2, 3, 4])
+        self.assertEqual(after, 4)
+        users, after = User.query.paginate_by(User.id_, after=after, page_size=4)
+        self.assertEqual([x.id_ for x in users], [5, 6, 7, 8])
+        users, after = User.query.paginate_by(User.id_, after=after, page_size=4)
+        self.assertEqual(([x.id_ for x in users], after), ([9, 10], None))
+
+        # 按字符串倒序: user9, user8, user7 | user6, user5, user4 | ...
+        users, after = User.query.paginate_by((User.name, User.id_), page_size=3, desc=True)
+        self.assertEqual(([x.id_ for x in users], after), ([9, 8, 7], ("user7", 7)))
+        users, after = User.query.paginate_by((User.name, User.id_), after=after, page_size=3, desc=True)
+        self.assertEqual(([x.id_ for x in users], after), ([6, 5, 4], ("user4", 4)))
+
+        pages = list(User.query.filter(User.id_ > 2).chunked(3))
+        self.assertEqual([len(x) for x in pages], [3, 3, 2])
+
+    def test_release_on_error(self):
+        pool = db.get_pool()
+        in_use = pool.stats()["in_use"]
+        self.assertRaises(KeyError, db.session.update, User(name="haihui"), name="linghaihui")
+        self.assertRaises(AttributeError, db.session.add, object())
+        self.assertRaises(AttributeError, db.session.add_all, [object()])
+        self.assertEqual(db.session.update(User(id_=1), foo=1), False)
+        self.assertEqual(pool.stats()["in_use"], in_use)
+
+        def rollback():
+            raise OperationalError(2013, "Lost connection to MySQL server during query")
+        broken = pool.stats()["broken"]
+        with self.assertRaises(ValueError):
+            with db.transaction():
+                db.session.rollback = rollback
+                raise ValueError()
+        self.assertEqual(pool.stats()["broken"], broken + 1)
+        self.assertEqual(pool.stats()["in_use"], in_use)
+
+    def test_aggregate(self):
+        db.session.add_all([User(id_=x, name="user%s" % (x % 2)) for x in range(1, 11)])
+        self.assertEqual(User.query.count(), 10)
+        self.assertEqual(User.query.filter(User.id_ > 7).count(), 3)
+        self.assertEqual(User.query.limit(4).count(), 4)
+        self.assertEqual(User.query.group_by(User.name).count(), 2)
+        self.assertEqual(User.query.filter(User.id_ > 9).group_by(User.name).count(), 1)
+        self.assertRaises(Exception, User.query.group_by(User.name).sum, User.id_)
+        assert User.query.filter(User.id_ == 3).exists()
+        assert not User.query.filter(User.id_ == 30).exists()
+        self.assertEqual(User.query.sum(User.id_), 55)
+        self.assertEqual(User.query.min(User.id_), 1)
+        self.assertEqual(User.query.filter(User.name == "user0").max(User.id_), 10)
+        result = User.query.group_by(User.name).order_by(User.name.asc()).aggregate("COUNT(*)", User.id_.max())
+        self.assertEqual(result, [("user0", 5, 10), ("user1", 5, 9)])
+        self.assertEqual(User.query.aggregate(User.id_.count(), User.id_.min()), (10, 1))
+        self.assertEqual(User.query.group_by("DATE_FORMAT(create_time,'%Y')").aggregate("COUNT(*)"), [(None, 10)])
+        self.assertEqual(len(User.query.order_by("FIELD(name,'50%')").all()), 10)
+
+    def test_only_defer(self):
+        db.session.add_all([User(id_=x, name="user%s" % x, create_time=datetime.now()) for x in range(1, 4)])
+        users = User.query.only(User.name).order_by(User.id_.asc()).all()
+        self.assertEqual(sorted(users[0].keys()), ["id_", "name"])
+        db.session.do_execute("UPDATE tt.user SET create_time=NULL WHERE id=3")
+        assert users[0].create_time is not None
+        assert users[2].create_time is None
+        self.assertEqual(sorted(users[1].keys()), ["create_time", "id_", "name"])
+
+        users = User.query.defer(User.name).all()
+        assert all([x.name.startswith("user") for x in users])
+
+        self.assertEqual(User.query.order_by(User.id_.asc()).values_list(User.id_, flat=True), [1, 2, 3])
+        self.assertEqual(User.query.filter(User.id_ == 1).values(User.id_, User.name),
+                         [{"id_": 1, "name": "user1"}])
+        self.assertEqual(User.query.filter(User.id_ == 1).values("id_", "name"),
+                         [{"id_": 1, "name": "user1"}])
+        self.assertEqual(User.query.order_by(User.id_.asc()).values_list("id_", flat=True), [1, 2, 3])
+
+    def test_transaction(self):
+        try:
+            with db.transaction():
+                db.session.add(User(id_=1, name="linghaihui"))
+                self.assertEqual(User.query.count(), 1)
+                raise ValueError("rollback")
+        except ValueError:
+            pass
+        self.assertEqual(User.query.count(), 0)
+
+        with db.transaction() as tx:
+            db.session.add(User(id_=1, name="linghaihui"))
+            user = User.get(1)
+            for x in range(2, 6):
+                tx.add(User(id_=x, name="user%s" % x))
+            tx.update(user, name="haihui")
+            tx.update(User(id_=3), name="updated")
+            self.assertEqual(User.query.count(), 1)
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(User.get(1).name, "haihui")
+        self.assertEqual(User.get(3).name, "updated")
+
+    def test_params(self):
+        user = User(id_=1, name="ling'hai\"hui%", create_time=datetime.now())
+        db.session.add(user)
+        result = User.query.filter(User.name == "ling'hai\"hui%").all()
+        assert len(result) == 1 and result[0].name == "ling'hai\"hui%"
+
+        result = User.query.filter(User.name == "\" or 1=1 or \"").all()
+        assert len(result) == 0
+
+        result = User.query.filter("name like 'ling%'", User.id_ == 1).all()
+        assert len(result) == 1
+
+        result = User.query.filter((User.id_ == 2) | (User.name == "o'neil%")).all()
+        assert len(result) == 0
+        result = User.query.filter((User.id_ == 1) & (User.name == "ling'hai\"hui%")).all()
+        assert len(result) == 1
+        with self.assertRaises(Exception):
+            User.query.filter("(%s OR %s)" % (User.id_ == 1, User.name == "a"))
+
+        db.session.update(user, name="o'neil")
+        self.assertEqual(User.get(1).name, "o'neil")
+        self.assertEqual(User.get((1, )).name, "o'neil")
+        assert User.get_sql() is User.get_sql()
+
+    def test_identity_map(self):
+        db.session.add(User(id_=1, name="linghaihui"))
+        db.session.add(User(id_=2, name="haihui"))
+        with db.identity_map():
+            user = User.get(1)
+            assert User.get(1) is user
+            result = User.query.order_by(User.id_.asc()).all()
+            assert result[0] is user and len(result) == 2
+            db.session.update(user, name="ling")
+            assert User.get(1) is user and user.name == "ling"
+        assert User.get(1) is not User.get(1)
+
+    def test_cache(self):
+        cache = db.setup_cache(max_entries=2)
+        try:
+            db.session.add(CachedUser(id_=1, name="linghaihui"))
+            self.assertEqual(len(CachedUser.query.all()), 1)
+            self.assertEqual(len(CachedUser.query.all()), 1)
+            self.assertEqual(CachedUser.get(1).name, "linghaihui")
+            self.assertEqual(CachedUser.get(1).name, "linghaihui")
+            stats = cache.stats()
+            self.assertEqual((stats["hits"], stats["misses"]), (2, 2))
+
+            db.session.do_execute("UPDATE tt.user SET name='haihui' WHERE id=1")
+            self.assertEqual(CachedUser.get(1).name, "haihui")
+            db.session.add(CachedUser(id_=2, name="haihui"))
+            self.assertEqual(len(CachedUser.query.all()), 2)
+            CachedUser.query.filter(CachedUser.id_ == 2).all()
+            self.assertEqual(cache.stats()["evictions"], 1)
+
+            hits = cache.stats()["hits"]
+            with db.transaction():
+                db.session.add(CachedUser(id_=3, name="haihui"))
+                self.assertEqual(len(CachedUser.query.all()), 3)
+            self.assertEqual(cache.stats()["hits"], hits)
+            try:
+                with db.transaction():
+                    db.session.add(CachedUser(id_=4, name="haihui"))
+                    CachedUser.query.all()
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.assertEqual(len(CachedUser.query.all()), 3)
+        finally:
+            db._cache = None
+
+    def test_slots(self):
+        now = datetime.now().replace(microsecond=0)
+        db.session.add(User(id_=1, name="linghaihui", create_time=now))
+        user = User.query.first()
+        assert not hasattr(user, "__dict__")
+        self.assertEqual((user.id_, user.name, user.create_time), (1, "linghaihui", now))
+        self.assertEqual(sorted(user.keys()), ["create_time", "id_", "name"])
+        user.extra = "extra"
+        self.assertEqual(user["extra"], "extra")
+        self.assertEqual(list(User(name="haihui").keys()), ["name"])
+
+    def test_replicas(self):
+        base = db.get_pool()
+        db.setup_replicas([{"host": base.host, "weight": 1}], pin_seconds=1)
+        try:
+            replica = db.get_replicas().pools[0][0]
+            con = db.read_session
+            assert con.pool is replica
+            replica.put(con)
+            db.session.add(User(id_=1, name="linghaihui"))
+            con = db.read_session
+            assert con.pool is base
+            base.put(con)
+            with db.use_primary():
+                self.assertEqual(User.get(1).name, "linghaihui")
+        finally:
+            db.setup_replicas(None)
+
+    def test_replica_fallback(self):
+        base = db.get_pool()
+        db.setup_replicas([{"host": base.host, "pool_max_size": 1}], checkout_timeout=0.1)
+        try:
+            replica = db.get_replicas().pools[0][0]
+            held = db.read_session
+            con = db.read_session
+            assert held.pool is replica and con.pool is base
+            base.put(con)
+            held.close()
+            self.assertRaises(Exception, held.select, "SELECT 1")
+            self.assertEqual(replica.stats()["broken"], 1)
+            self.assertEqual(db.get_replicas().available(), [])
+            con = db.read_session
+            assert con.pool is base
+            base.put(con)
+        finally:
+            db.setup_replicas(None)
+
+    def test_iter(self):
+        db.session.add_all([User(id_=x, name="user%s" % x) for x in range(1, 11)])
+        result = list(User.query.filter(User.id_ > 5).order_by(User.id_.asc()).iter(batch_size=2))
+        assert len(result) == 5 and result[0].id_ == 6 and isinstance(result[0], User)
+
+        users = User.query.iter(batch_size=3)
+        assert isinstance(next(users), User)
+        users.close()
+        self.assertEqual(len(User.query.all()), 10)
+
+    def test_pipeline(self):
+        db.session.add_all([User(id_=x, name="user%s" % x) for x in range(1, 6)])
+        users, rows, first = db.session.pipeline([
+            User.query.filter(User.id_ > 2).order_by(User.id_.asc()),
+            ("SELECT COUNT(*) FROM tt.user WHERE name LIKE %s", ["user%"]),
+            User.query.filter(User.name == "user1")])
+        self.assertEqual([x.id_ for x in users], [3, 4, 5])
+        self.assertEqual(rows[0][0], 5)
+        assert isinstance(first[0], User) and first[0].id_ == 1
+        self.assertEqual(db.session.pipeline([]), [])
+        db.session.add(User(id_=6, name="凌海辉"))
+        users, rows = db.session.pipeline([User.query.filter(User.name == "凌海辉"), ("SELECT %s", ["海辉"])])
+        self.assertEqual([x.id_ for x in users], [6])
+        self.assertEqual(rows[0][0], "海辉")
+        # pipeline之外不能一次执行多条语句
+        self.assertRaises(Exception, db.session.select, "SELECT 1; SELECT 2")
+
+    def test_shards(self):
+        base = db.get_pool()
+        other = Pool(base.host, base.port, base.user, base.password, base.db, base.charset)
+        # 两个分片指向同一个库，所有分片的查询会把每条记录查到两次
+        db.setup_shards([base, other])
+        try:
+            db.session.add_all([ShardedUser(id_=x, name="user%s" % x) for x in range(1, 5)])
+            db.session.add(ShardedUser(id_=5, name="user5"))
+            db.session.update(ShardedUser(id_=5), name="haihui")
+            self.assertEqual(ShardedUser.get(5).name, "haihui")
+            self.assertEqual(len(ShardedUser.query.filter(ShardedUser.id_ == 1).all()), 1)
+            self.assertIs(db.get_shards().pool_for(ShardedUser, "3"), db.get_shards().pool_for(ShardedUser, 3))
+            self.assertEqual(ShardedUser.get("3").name, "user3")
+            users = ShardedUser.query.order_by(ShardedUser.id_.desc()).limit(3).offset(1).all()
+            self.assertEqual([x.id_ for x in users], [5, 4, 4])
+            users = ShardedUser.query.order_by(ShardedUser.id_.asc()).iter(batch_size=2)
+            self.assertEqual([x.id_ for x in users], [1, 1, 2, 2, 3, 3, 4, 4, 5, 5])
+            # 提前结束时没有读取的分片不会占用连接
+            self.assertEqual(len(list(ShardedUser.query.limit(1).iter())), 1)
+            self.assertEqual(other.in_use, 0)
+            # 延迟加载的字段也从分片读取
+            users = ShardedUser.query.only(ShardedUser.id_).order_by(ShardedUser.id_.asc()).all()
+            self.assertEqual([x.name for x in users][::2], ["user1", "user2", "user3", "user4", "haihui"])
+            self.assertEqual(len(set([x.name for x in users])), 5)
+            self.assertEqual(ShardedUser.query.count(), 10)
+            self.assertEqual(ShardedUser.query.max(ShardedUser.id_), 5)
+            self.assertRaises(Exception, db.session.update, ShardedUser(id_=1), id_=2)
+        finally:
+            db.setup_shards(None)
+
+    def test_gather(self):
+        db.session.add_all([User(id_=x, name="user%s" % x) for x in range(1, 6)])
+        users, count, error, name = db.gather(
+            User.query.filter(User.id_ > 3),
+            lambda: User.query.count(),
+            lambda: db.session.select("SELECT * FROM tt.not_exist"),
+            lambda: User.get(1).name,
+            max_workers=3)
+        self.assertEqual(sorted([x.id_ for x in users]), [4, 5])
+        self.assertEqual((count, name), (5, "user1"))
+        assert isinstance(error, Exception)
+        self.assertEqual(db.get_pool().in_use, 0)
+
+    def test_profiler(self):
+        profiler = db.setup_profiler(slow_seconds=None)
+        try:
+            db.session.add_all([User(id_=x, name="user%s" % x) for x in range(1, 6)])
+            for x in range(1, 6):
+                User.query.filter(User.id_ == x).all()
+            User.query.filter(User.id_.in_([1, 2])).all()
+            User.query.filter(User.id_.in_([1, 2, 3])).all()
+            report = dict([(x["fingerprint"], x) for x in profiler.report()])
+            stat = report["select `create_time`,`id`,`name` from tt.user where id=?"]
+            self.assertEqual((stat["count"], stat["rows"]), (5, 5))
+            assert 0 < stat["p50"] <= stat["p99"] <= stat["max"]
+            self.assertEqual(report["select `create_time`,`id`,`name` from tt.user where id in (?+)"]["count"], 2)
+            self.assertEqual(report["insert into tt.user (`id`,`name`) values (?+)"]["rows"], 5)
+            for user in User.query.order_by(User.id_.asc()).iter(batch_size=2):
+                time.sleep(0.1)
+            report = dict([(x["fingerprint"], x) for x in profiler.report()])
+            stat = report["select `create_time`,`id`,`name` from tt.user order by id asc"]
+            self.assertEqual(stat["rows"], 5)
+            assert stat["max"] < 0.1
+        finally:
+            db._profiler = None
+
+    def test_to_columns(self):
+        now = datetime(2020, 1, 1)
+        db.session.add_all([User(id_=x, name="user%s" % x, create_time=now) for x in range(1, 6)])
+        columns = User.query.order_by(User.id_.asc()).to_columns(batch_size=2)
+        self.assertEqual(list(columns["id_"]), [1, 2, 3, 4, 5])
+        self.assertEqual(columns["id_"].typecode, "l")
+        self.assertEqual(columns["name"][0], "user1")
+        self.assertEqual(list(columns["create_time"]), [1577836800.0] * 5)
+        columns = User.query.filter(User.id_ > 3).to_columns(User.id_)
+        self.assertEqual(list(columns.keys()), ["id_"])
+        self.assertEqual(sorted(columns["id_"]), [4, 5])
+
+    def test_load(self):
+        now = datetime.now().replace(microsecond=0)
+        rows = ((x, "user\t%s" % x, now) for x in range(1, 1001))
+        result = db.session.load(User, rows, fields=["id_", "name", "create_time"], chunk_size=300)
+        self.assertEqual((result["rows"], result["warnings"]), (1000, 0))
+        user = User.get(1000)
+        self.assertEqual((user.name, user.create_time), ("user\t1000", now))
+
+        result = db.session.load(User, [User(id_=1, name="haihui"), User(id_=1001, name=None)],
+                                 duplicates="replace")
+        self.assertEqual(User.get(1).name, "haihui")
+        self.assertEqual(User.query.count(), 1001)
+
+    def test_get_many(self):
+        db.session.add_all([User(id_=x, name="user%s" % x, create_time=datetime.now()) for x in range(1, 6)])
+        users, missing = User.get_many([3, 1, 3, 100, 5], chunk_size=2)
+        self.assertEqual(sorted(users), [1, 3, 5])
+        self.assertEqual(users[3].name, "user3")
+        self.assertEqual(missing, [100])
+        self.assertEqual(User.get_many([]), ({}, []))
+        users, missing = User.get_many([1, 2L, "3", 3])
+        self.assertEqual((users["3"].name, users[3].name, users[2].name, missing), ("user3", "user3", "user2", []))
+        with db.identity_map():
+            user = User.get(1)
+            self.assertIs(User.get_many([1, 2])[0][1], user)
+
+    def test_prefetch(self):
+        db.session.add_all([User(id_=x, name="user%s" % x, create_time=datetime.now()) for x in range(1, 4)])
+        profiles = Profile.query.prefetch("owner").order_by(Profile.name.asc()).all()
+        self.assertEqual([(x.owner_id, x.owner.name) for x in profiles], [(1, "user1"), (2, "user2"), (3, "user3")])
+        profile = Profile.get("user1")
+        self.assertEqual(profile.owner.id_, 1)
+        profile.owner_id = 2
+        self.assertEqual(profile.owner.name, "user2")
+        profile.owner_id = 100
+        self.assertIsNone(profile.owner)
+        profile.owner_id = "3"
+        self.assertEqual(profile.owner.name, "user3")
+        self.assertRaises(Exception, Profile.query.prefetch, "user")
+
+    def test_export(self):
+        now = datetime(2020, 1, 1)
+        db.session.add_all([User(id_=x, name="user,%s" % x, create_time=now) for x in range(1, 4)])
+        f = io.BytesIO()
+        count = User.query.order_by(User.id_.asc()).export(f, chunk_size=2, fields=["id_", "name", "create_time"])
+        self.assertEqual(count, 3)
+        self.assertEqual(f.getvalue().splitlines()[:2],
+                         [b"id_,name,create_time", b'1,"user,1",2020-01-01 00:00:00'])
+        f = io.BytesIO()
+        User.query.filter(User.id_ == 3).export(f, format="jsonl", gzip=True, fields=[User.id_, User.create_time])
+        content = gzip.GzipFile(fileobj=io.BytesIO(f.getvalue())).read()
+        self.assertEqual(json.loads(content), {"id_": 3, "create_time": "2020-01-01 00:00:00"})
+
 
 class TestPool(unittest.TestCase):
 
@@ -162,6 +593,43 @@ class TestPool(unittest.TestCase):
             try_times -= 1
         print "test_get done !!!"
 
+    def test_bounded(self):
+        base = db.get_pool()
+        pool = Pool(base.host, base.port, base.user, base.password, base.db, base.charset,
+                    pool_max_size=2, min_idle=1, timeout=0.5, max_overflow=1)
+        time.sleep(0.5)
+        self.assertEqual(len(pool.idle), 1)
+        a, b, c = pool.connection, pool.connection, pool.connection
+        assert c.overflow and not a.overflow and not b.overflow
+        try:
+            pool.connection
+            assert False
+        except Exception as e:
+            assert "timeout" in e.message
+        pool.put(c)
+        self.assertEqual(pool.overflow, 0)
+        pool.put(a)
+        pool.put(a)
+        self.assertEqual(len(pool.idle), 1)
+        assert pool.connection is a
+
+    def test_stats(self):
+        base = db.get_pool()
+        events = []
+        pool = Pool(base.host, base.port, base.user, base.password, base.db, base.charset,
+                    pool_max_size=2, max_life_time=0, metrics_callback=lambda name, v: events.append(name))
+        con = pool.connection
+        stats = pool.stats()
+        self.assertEqual(stats["created"], 1)
+        self.assertEqual(stats["in_use"], 1)
+        self.assertEqual(stats["checkout_wait"]["count"], 1)
+        pool.put(con)
+        stats = pool.stats()
+        self.assertEqual(stats["recycled"], 1)
+        self.assertEqual(stats["closed"], 1)
+        self.assertEqual(stats["idle"], 0)
+        assert "created" in events and "checkout_wait" in events
+
 
 if __name__ == "__main__":
     unittest.main()